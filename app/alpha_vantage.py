@@ -0,0 +1,191 @@
+import asyncio
+import datetime
+import itertools
+from utils import get_api_key
+from http_clients import get_http_client
+from rate_limit import DailyQuota, TokenBucket
+
+# All Alpha Vantage traffic goes through one scheduler so bursts queue up instead of
+# tripping the rate limit. Limits match the key's plan, adjust them if the plan changes.
+ALPHA_VANTAGE_URL = 'https://www.alphavantage.co/query'
+ALPHA_VANTAGE_REQUESTS_PER_MINUTE = 5
+ALPHA_VANTAGE_REQUESTS_PER_DAY = 25
+# Alpha Vantage doesn't document when its daily count resets, UTC midnight is assumed
+ALPHA_VANTAGE_DAY_RESET_TIMEZONE = datetime.timezone.utc
+ALPHA_VANTAGE_MAX_RATE_LIMIT_RETRIES = 1
+
+# Lower number runs first. Interactive requests from the endpoints go ahead of background work such as quote hedges.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+# Background queries are refused once the day's remaining calls drop to this, so FX and primary quote lookups keep them
+ALPHA_VANTAGE_DAY_RESERVE_FOR_INTERACTIVE = 10
+
+
+class AlphaVantageRateLimitError(Exception):
+    pass
+
+
+# The minute limit is per key but short enough to track per process. The day's quota is shared by every worker through Redis.
+_minute_bucket = TokenBucket(ALPHA_VANTAGE_REQUESTS_PER_MINUTE, 60)
+_day_quota = DailyQuota('alpha_vantage', ALPHA_VANTAGE_REQUESTS_PER_DAY, ALPHA_VANTAGE_DAY_RESET_TIMEZONE)
+_queue = None
+# Query key -> {'future', 'waiters', 'priority', 'dispatched'} for every query queued or in flight
+_pending = {}
+_sequence = itertools.count()
+_scheduler_task = None
+_stats = {'requests_sent': 0, 'deduplicated': 0, 'rate_limited_responses': 0, 'rejected_over_daily_quota': 0, 'rejected_background_over_reserve': 0, 'abandoned': 0, 'errors': 0}
+
+
+def is_rate_limit_response(resp_json: dict) -> bool:
+    # Alpha Vantage answers HTTP 200 with a single Note or Information message when a key is over its limits, e.g.
+    # {"Note": "Thank you for using Alpha Vantage! Our standard API call frequency is 5 calls per minute and 500 calls per day..."}
+    # {"Information": "... rate limit is 25 requests per day ..."}
+    message = resp_json.get('Note') or resp_json.get('Information') or ''
+    return len(resp_json) == 1 and ('call frequency' in message or 'rate limit' in message)
+
+
+async def execute_alpha_vantage_query(params: dict, query: dict, attempt: int) -> None:
+    future = query['future']
+    try:
+        response = await get_http_client('alpha_vantage').get(ALPHA_VANTAGE_URL, params={**params, 'apikey': get_api_key('alpha_vantage')})
+        _stats['requests_sent'] += 1
+        resp_json = response.json()
+        if is_rate_limit_response(resp_json):
+            _stats['rate_limited_responses'] += 1
+            _minute_bucket.drain()
+            if attempt < ALPHA_VANTAGE_MAX_RATE_LIMIT_RETRIES:
+                # Requeue at the front so it goes out as soon as the minute window frees up
+                query['dispatched'] = False
+                _queue.put_nowait((PRIORITY_INTERACTIVE - 1, next(_sequence), params, query, attempt + 1))
+                return
+            raise AlphaVantageRateLimitError(next(iter(resp_json.values())))
+        # Every waiter may have given up while the request was in flight
+        if not future.done():
+            future.set_result(resp_json)
+    except Exception as e:
+        _stats['errors'] += 1
+        if not future.done():
+            future.set_exception(e)
+
+
+def get_day_limit(priority: int) -> int:
+    # Background queries stop short of the whole quota, leaving the reserve for interactive ones
+    if priority >= PRIORITY_BACKGROUND:
+        return _day_quota.limit - ALPHA_VANTAGE_DAY_RESERVE_FOR_INTERACTIVE
+    return _day_quota.limit
+
+
+def reject_over_daily_quota(query: dict) -> None:
+    if query['future'].done():
+        return
+    if _day_quota.remaining() > 0:
+        _stats['rejected_background_over_reserve'] += 1
+        query['future'].set_exception(AlphaVantageRateLimitError('Alpha Vantage daily quota is down to the reserve for interactive requests.'))
+    else:
+        _stats['rejected_over_daily_quota'] += 1
+        query['future'].set_exception(AlphaVantageRateLimitError('Alpha Vantage daily request quota exhausted.'))
+
+
+async def run_alpha_vantage_scheduler() -> None:
+    while True:
+        _, _, params, query, attempt = await _queue.get()
+        future = query['future']
+        # Skips queries every waiter abandoned, and the older entry of a query that was requeued at a higher priority
+        if future.done() or query['dispatched']:
+            continue
+
+        day_limit = get_day_limit(query['priority'])
+        # Waiting hours for the daily window isn't useful to anyone, so fail fast on this worker's last view of the count
+        # instead of first waiting for the minute window
+        if _day_quota.remaining(day_limit) < 1:
+            reject_over_daily_quota(query)
+            continue
+
+        await _minute_bucket.acquire()
+        # The waiters may have given up while this waited for the minute window. The minute token is spent, the daily one isn't.
+        if future.done():
+            continue
+        if not await _day_quota.try_take(day_limit):
+            reject_over_daily_quota(query)
+            continue
+        query['dispatched'] = True
+
+        # Fire the request without waiting for it so slow responses don't hold up the next slot
+        asyncio.create_task(execute_alpha_vantage_query(params, query, attempt))
+
+
+def start_alpha_vantage_scheduler() -> None:
+    global _queue, _scheduler_task
+    if _scheduler_task is None or _scheduler_task.done():
+        _queue = asyncio.PriorityQueue()
+        _scheduler_task = asyncio.create_task(run_alpha_vantage_scheduler())
+
+
+async def stop_alpha_vantage_scheduler() -> None:
+    global _scheduler_task
+    if _scheduler_task is not None:
+        _scheduler_task.cancel()
+        try:
+            await _scheduler_task
+        except asyncio.CancelledError:
+            pass
+        _scheduler_task = None
+
+
+async def query_alpha_vantage(params: dict, priority: int = PRIORITY_INTERACTIVE) -> dict:
+    """
+    Queues an Alpha Vantage query behind the per-minute and per-day limits and returns the parsed JSON.
+    Identical queries already waiting or in flight share one upstream call. A query whose callers have all been
+    cancelled (e.g. the losing side of a quote hedge) is dropped from the queue and doesn't spend any quota.
+
+    :param params: Query parameters without the API key (e.g., {'function': 'OVERVIEW', 'symbol': 'IBM'}).
+    :param priority: PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND. Lower runs first, and background queries are refused
+        once the day's remaining calls are down to ALPHA_VANTAGE_DAY_RESERVE_FOR_INTERACTIVE.
+    :return: The response JSON.
+    :raises AlphaVantageRateLimitError: If the quota is exhausted or Alpha Vantage keeps returning its rate limit message.
+    """
+    # Starts on first use so callers outside the app lifespan still work
+    start_alpha_vantage_scheduler()
+
+    key = tuple(sorted(params.items()))
+    query = _pending.get(key)
+    if query is not None:
+        _stats['deduplicated'] += 1
+        if priority < query['priority'] and not query['dispatched']:
+            # Queue it again at the more urgent priority. Whichever entry comes out first sends it.
+            query['priority'] = priority
+            _queue.put_nowait((priority, next(_sequence), params, query, 0))
+    else:
+        future = asyncio.get_running_loop().create_future()
+        query = {'future': future, 'waiters': 0, 'priority': priority, 'dispatched': False}
+        _pending[key] = query
+        future.add_done_callback(lambda done_future: _pending.pop(key, None) if _pending.get(key) is query else None)
+        _queue.put_nowait((priority, next(_sequence), params, query, 0))
+
+    query['waiters'] += 1
+    try:
+        # Shielded so one cancelled caller doesn't fail the others sharing the query
+        return await asyncio.shield(query['future'])
+    finally:
+        query['waiters'] -= 1
+        if query['waiters'] == 0 and not query['future'].done():
+            # The last caller gave up, so the scheduler skips the query (or ignores the response if it's already in flight).
+            # Unlisted right away, since the done callback only runs on a later loop iteration and a new caller for the
+            # same key would otherwise join the cancelled future.
+            _stats['abandoned'] += 1
+            if _pending.get(key) is query:
+                del _pending[key]
+            query['future'].cancel()
+
+
+def get_alpha_vantage_quota_stats() -> dict:
+    return {
+        **_stats,
+        'queued': _queue.qsize() if _queue is not None else 0,
+        'pending_queries': len(_pending),
+        'minute_tokens_remaining': round(_minute_bucket.tokens(), 2),
+        'minute_capacity': ALPHA_VANTAGE_REQUESTS_PER_MINUTE,
+        # As of this worker's last call, other workers share the quota
+        'day_remaining': _day_quota.remaining(),
+        'day_capacity': _day_quota.limit,
+    }
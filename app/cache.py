@@ -0,0 +1,113 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+from metrics import register_cache
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one in-flight coroutine.
+    Every caller awaiting a key gets the result (or exception) of the first caller's fetch.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+
+    async def run(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._in_flight[key] = task
+            # Drop the key once the fetch settles, even if every waiter was cancelled
+            task.add_done_callback(lambda finished_task: self._in_flight.pop(key, None) if self._in_flight.get(key) is finished_task else None)
+        # Shield so one cancelled caller doesn't cancel the fetch the others are waiting on
+        return await asyncio.shield(task)
+
+    def in_flight_count(self) -> int:
+        return len(self._in_flight)
+
+
+class TTLCache:
+    """
+    In-memory LRU cache whose entries go stale after ttl_seconds.
+    Stale entries are kept until evicted so they can still be served when a refresh fails.
+    Named caches report their hit ratio on /metrics.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, name: str = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._flights = SingleFlight()
+        self._stats = {'hits': 0, 'misses': 0, 'stale_served': 0, 'evictions': 0}
+        if name is not None:
+            register_cache(name, self.stats)
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Returns the cached value if it is still fresh, otherwise None.
+        """
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl_seconds:
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def get_stale(self, key: Hashable) -> Any:
+        """
+        Returns the cached value regardless of age, or None if the key was never cached or has been evicted.
+        """
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def set(self, key: Hashable, value: Any, age_seconds: float = 0.0) -> None:
+        # age_seconds is for values that were already cached elsewhere for a while, so they don't outlive the TTL
+        self._entries[key] = (time.monotonic() - age_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def invalidate(self, key: Hashable = None) -> None:
+        """
+        Removes one key, or every key when none is given.
+        """
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], stale_on_error: bool = True) -> Any:
+        """
+        Returns the fresh cached value for key, or awaits fetch() to refresh it.
+        Concurrent misses for the same key share a single fetch. If the fetch raises and
+        stale_on_error is set, the last good value is returned instead when there is one.
+
+        :param key: The cache key (e.g., a ticker).
+        :param fetch: Zero-argument coroutine function producing the value. Should raise on failure.
+        :param stale_on_error: Whether to fall back to an expired value when fetch raises.
+        :return: The cached or freshly fetched value.
+        """
+        value = self.get(key)
+        if value is not None:
+            self._stats['hits'] += 1
+            return value
+
+        self._stats['misses'] += 1
+        try:
+            return await self._flights.run(key, lambda: self._fetch_and_store(key, fetch))
+        except Exception:
+            stale_value = self.get_stale(key) if stale_on_error else None
+            if stale_value is None:
+                raise
+            self._stats['stale_served'] += 1
+            return stale_value
+
+    async def _fetch_and_store(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = await fetch()
+        self.set(key, value)
+        return value
+
+    def stats(self) -> dict:
+        return {**self._stats, 'entries': len(self._entries), 'max_entries': self.max_entries, 'ttl_seconds': self.ttl_seconds, 'in_flight': self._flights.in_flight_count()}
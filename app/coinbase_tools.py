@@ -1,55 +1,264 @@
 from fastapi import APIRouter, Response, Query, Request, status, Header
-from utils import append_to_log, authorized_via_finance_token, get_secrets_dict, get_api_key, get_postgres_cursor_autocommit, get_postgres_timestamp_now, get_epoch_time
+from utils import append_to_log, authorized_via_finance_token, get_secrets_dict, get_api_key, get_postgres_timestamp_now, get_epoch_time, import_in_background
+from postgres_writer import BufferedPostgresWriter
+from metrics import CallbackCounter, CallbackGauge, upstream_request_duration, upstream_requests
+import asyncio
+import json
+import random
+import re
+import threading
 import time
-from typing import Annotated, DefaultDict
-from coinbase.websocket import WSClient
-import pandas as pd
+from typing import Annotated
+
+# The product universe. Each coin maps to its (spot, perp) product ids and is stored in <coin>_perp_futures,
+# which the writer creates before its first COPY. Adding a coin is just another entry here, e.g. 'sol': ('SOL-USD', 'SOL-PERP-INTX').
+COINBASE_PRODUCT_PAIRS = {
+    'btc': ('BTC-USD', 'BTC-PERP-INTX'),
+    'eth': ('ETH-USD', 'ETH-PERP-INTX'),
+}
+COINBASE_PRODUCT_IDS = [product_id for pair in COINBASE_PRODUCT_PAIRS.values() for product_id in pair]
+COINBASE_POSTGRES_DATABASE = 'cjremmett'
+COINBASE_TABLE_SUFFIX = '_perp_futures'
+# Same columns pandas.to_sql created the original tables with
+COINBASE_TABLE_COLUMNS = ['epoch', 'timestamp', 'spot_bid', 'spot_ask', 'perp_bid', 'perp_ask']
+COINBASE_TABLE_COLUMN_DEFINITIONS = 'epoch TEXT, timestamp TEXT, spot_bid DOUBLE PRECISION, spot_ask DOUBLE PRECISION, perp_bid DOUBLE PRECISION, perp_ask DOUBLE PRECISION'
+
+# One websocket subscription lives for the whole app and keeps per-product aggregates of the ticks since the last snapshot.
+# The SDK's own retry gives up after a few attempts, so it's turned off and the collector reconnects with backoff itself.
+COINBASE_WEBSOCKET_HOST = 'advanced-trade-ws.coinbase.com'
+COINBASE_CONNECT_TIMEOUT_SECONDS = 10
+COINBASE_HEALTH_CHECK_INTERVAL_SECONDS = 5
+# Heartbeats arrive every second, so this long without any message means the connection is dead even if the socket isn't closed
+COINBASE_STALE_CONNECTION_SECONDS = 30
+COINBASE_RECONNECT_MIN_SECONDS = 1
+COINBASE_RECONNECT_MAX_SECONDS = 60
+# A snapshot won't persist a quote older than this
+COINBASE_MAX_QUOTE_AGE_SECONDS = 60
+# Every tick is also kept in per-product ring buffers for basis analytics. The budget is split evenly between products.
+COINBASE_TICK_STORE_MAX_BYTES = 64 * 1024 * 1024
+COINBASE_BASIS_DEFAULT_WINDOW_SECONDS = 3600
 
 router = APIRouter()
 
+
 def get_coinbase_api_credentials() -> tuple:
     secrets_dict = get_secrets_dict()
     return secrets_dict['secrets']['coinbase_api_key']['name'], secrets_dict['secrets']['coinbase_api_key']['privateKey']
 
 
-def write_crypto_future_data_to_postgres(coin_ticker, spot_bid, spot_ask, perp_bid, perp_ask):
-   try:
-      with get_postgres_cursor_autocommit('cjremmett') as cursor:
-         table = coin_ticker + '_perp_futures'
-         log_line = pd.DataFrame({
-            'epoch': [get_epoch_time()],
-            'timestamp': [get_postgres_timestamp_now()],
-            'spot_bid': [spot_bid],
-            'spot_ask': [spot_ask],
-            'perp_bid': [perp_bid],
-            'perp_ask': [perp_ask]
-         })
-         log_line.to_sql(name=table, con=cursor, if_exists='append', index=False)
-   except Exception as e:
-      append_to_log('ERROR', 'Writing to coinbase table failed. Error:\n\n' + repr(e))
-
-
-btc = DefaultDict(float)
-eth = DefaultDict(float)
-def on_message(msg):
-    append_to_log('TRACE', msg)
-    if('product_id' in msg):
-        if(msg['product_id'] == 'BTC-USD'):
-            btc['spot_count'] += 1
-            btc['spot_bid'] += msg['best_bid']
-            btc['spot_ask'] += msg['best_ask']
-        elif(msg['product_id'] == 'ETH-USD'):
-            eth['spot_count'] += 1
-            eth['spot_bid'] += msg['best_bid']
-            eth['spot_ask'] += msg['best_ask']
-        elif(msg['product_id'] == 'BTC-PERP-INTX'):
-            btc['perp_count'] += 1
-            btc['perp_bid'] += msg['best_bid']
-            btc['perp_ask'] += msg['best_ask']
-        elif(msg['product_id'] == 'ETH-PERP-INTX'):
-            eth['perp_count'] += 1
-            eth['perp_bid'] += msg['best_bid']
-            eth['perp_ask'] += msg['best_ask']
+def get_crypto_futures_table(coin_ticker: str) -> str:
+    # The name goes straight into SQL, so only plain identifiers are allowed
+    table = coin_ticker + COINBASE_TABLE_SUFFIX
+    if not re.match('^[a-z0-9_]+$', table):
+        raise ValueError(f'Invalid crypto futures table name {table}.')
+    return table
+
+
+def get_crypto_futures_writer() -> BufferedPostgresWriter:
+    writer = BufferedPostgresWriter(COINBASE_POSTGRES_DATABASE)
+    for coin_ticker in COINBASE_PRODUCT_PAIRS:
+        writer.register_table(get_crypto_futures_table(coin_ticker), COINBASE_TABLE_COLUMNS, COINBASE_TABLE_COLUMN_DEFINITIONS)
+    return writer
+
+
+class ProductAccumulator:
+    """
+    Collects one product's ticks: the running bid/ask sums since the last snapshot, the last quote,
+    and every tick in a ring buffer for analytics.
+    """
+
+    def __init__(self, product_id: str, tick_buffer: 'TickRingBuffer'):
+        self.product_id = product_id
+        self.tick_buffer = tick_buffer
+        self.ticks = 0
+        self.bid_sum = 0.0
+        self.ask_sum = 0.0
+        self.last_bid = None
+        self.last_ask = None
+        self.last_tick_at = None
+        # add runs on the websocket thread, snapshot on the event loop
+        self.lock = threading.Lock()
+
+    def add(self, timestamp: float, bid: float, ask: float) -> None:
+        with self.lock:
+            self.ticks += 1
+            self.bid_sum += bid
+            self.ask_sum += ask
+            self.last_bid, self.last_ask, self.last_tick_at = bid, ask, timestamp
+        self.tick_buffer.append(timestamp, bid, ask)
+
+    def snapshot(self, now: float) -> dict:
+        # Average since the previous snapshot, or the last quote if nothing has ticked since. None if never quoted.
+        with self.lock:
+            if self.last_tick_at is None:
+                return None
+            if self.ticks > 0:
+                bid, ask = self.bid_sum / self.ticks, self.ask_sum / self.ticks
+            else:
+                bid, ask = self.last_bid, self.last_ask
+            snapshot = {'bid': bid, 'ask': ask, 'ticks': self.ticks, 'age_seconds': now - self.last_tick_at}
+            self.ticks, self.bid_sum, self.ask_sum = 0, 0.0, 0.0
+        return snapshot
+
+    def stats(self) -> dict:
+        return {'last_bid': self.last_bid, 'last_ask': self.last_ask, 'ticks_since_snapshot': self.ticks, 'last_tick_at': self.last_tick_at, 'tick_buffer': self.tick_buffer.stats()}
+
+
+# Dispatch table from product_id to its accumulator, so handling a tick costs the same however many products are subscribed.
+# Filled when the collector starts, which is also when numpy (for the tick buffers) and the Coinbase SDK get imported.
+_accumulators = {}
+crypto_futures_writer = get_crypto_futures_writer()
+_collector_task = None
+_collector_stats = {'connects': 0, 'reconnects': 0, 'messages': 0, 'ticks': 0, 'message_errors': 0, 'connected': False, 'last_message_at': None}
+
+
+def on_message(msg: str) -> None:
+    # Runs on the SDK's websocket thread for every message. Ticker messages look like
+    # {"channel": "ticker", "events": [{"type": "update", "tickers": [{"product_id": "BTC-USD", "best_bid": "67000.1", "best_ask": "67000.2", ...}]}]}
+    # An exception here would kill the SDK's message handler, so nothing is allowed to escape. Nothing is logged per tick either.
+    try:
+        now = time.time()
+        _collector_stats['messages'] += 1
+        _collector_stats['last_message_at'] = now
+        message = json.loads(msg)
+        if message.get('channel') != 'ticker':
+            return
+        for event in message.get('events', []):
+            for ticker in event.get('tickers', []):
+                accumulator = _accumulators.get(ticker.get('product_id'))
+                if accumulator is not None:
+                    accumulator.add(now, float(ticker['best_bid']), float(ticker['best_ask']))
+                    _collector_stats['ticks'] += 1
+    except Exception as e:
+        _collector_stats['message_errors'] += 1
+        append_to_log('ERROR', f'Failed to handle Coinbase websocket message: {repr(e)}')
+
+
+def create_product_accumulators() -> None:
+    from tick_store import create_tick_buffers
+    if not _accumulators:
+        _accumulators.update({product_id: ProductAccumulator(product_id, tick_buffer) for product_id, tick_buffer in create_tick_buffers(COINBASE_PRODUCT_IDS, COINBASE_TICK_STORE_MAX_BYTES).items()})
+
+
+def take_coinbase_snapshot() -> dict:
+    """
+    Returns each product's average bid and ask since the previous snapshot and starts a new window.
+    A product with no ticks in the window falls back to its last quote.
+
+    :return: {product_id: {'bid', 'ask', 'ticks', 'age_seconds'}} for every product that has been quoted at least once.
+    """
+    now = time.time()
+    snapshots = {product_id: accumulator.snapshot(now) for product_id, accumulator in _accumulators.items()}
+    return {product_id: snapshot for product_id, snapshot in snapshots.items() if snapshot is not None}
+
+
+def close_coinbase_client(client: 'WSClient') -> None:
+    # WSClient.close raises if the socket already dropped, and then leaves its event loop thread running, so stop that ourselves
+    try:
+        client.close()
+    except Exception:
+        if client.loop is not None and not client.loop.is_closed():
+            client.loop.call_soon_threadsafe(client.loop.stop)
+            client.thread.join()
+            client.loop.close()
+
+
+async def run_coinbase_collector() -> None:
+    # numpy and the Coinbase SDK are imported here in worker threads rather than when the app starts
+    await asyncio.to_thread(create_product_accumulators)
+    await import_in_background('coinbase.websocket')
+    from coinbase.websocket import WSClient
+    reconnect_delay = COINBASE_RECONNECT_MIN_SECONDS
+    while True:
+        client = None
+        try:
+            api_credentials = get_coinbase_api_credentials()
+            client = WSClient(api_key=api_credentials[0], api_secret=api_credentials[1], on_message=on_message, timeout=COINBASE_CONNECT_TIMEOUT_SECONDS, retry=False)
+
+            # The SDK's open and subscribe block until its own thread has done the work
+            _collector_stats['last_message_at'] = time.time()
+            connect_start = time.monotonic()
+            try:
+                await asyncio.to_thread(client.open)
+                await asyncio.to_thread(client.subscribe, product_ids=COINBASE_PRODUCT_IDS, channels=['ticker', 'heartbeats'])
+            except Exception:
+                upstream_request_duration.observe(('coinbase', COINBASE_WEBSOCKET_HOST), time.monotonic() - connect_start)
+                upstream_requests.inc(('coinbase', COINBASE_WEBSOCKET_HOST, 'transport_error'))
+                raise
+            upstream_request_duration.observe(('coinbase', COINBASE_WEBSOCKET_HOST), time.monotonic() - connect_start)
+            upstream_requests.inc(('coinbase', COINBASE_WEBSOCKET_HOST, 'ok'))
+            _collector_stats['connects'] += 1
+            _collector_stats['connected'] = True
+            append_to_log('INFO', f'Coinbase collector subscribed to {", ".join(COINBASE_PRODUCT_IDS)}.')
+
+            while True:
+                await asyncio.sleep(COINBASE_HEALTH_CHECK_INTERVAL_SECONDS)
+                client.raise_background_exception()
+                if time.time() - _collector_stats['last_message_at'] > COINBASE_STALE_CONNECTION_SECONDS:
+                    raise Exception(f'No Coinbase websocket messages in {COINBASE_STALE_CONNECTION_SECONDS} seconds.')
+                # Healthy for a full check, so the next disconnect starts backing off from the minimum again
+                reconnect_delay = COINBASE_RECONNECT_MIN_SECONDS
+
+        except Exception as e:
+            append_to_log('ERROR', f'Coinbase collector disconnected, reconnecting in about {reconnect_delay} seconds: {repr(e)}')
+            _collector_stats['reconnects'] += 1
+        finally:
+            _collector_stats['connected'] = False
+            if client is not None:
+                await asyncio.to_thread(close_coinbase_client, client)
+
+        # Jittered exponential backoff
+        await asyncio.sleep(reconnect_delay * random.uniform(0.5, 1.0))
+        reconnect_delay = min(COINBASE_RECONNECT_MAX_SECONDS, reconnect_delay * 2)
+
+
+def start_coinbase_collector() -> None:
+    global _collector_task
+    crypto_futures_writer.start()
+    if _collector_task is None or _collector_task.done():
+        _collector_task = asyncio.create_task(run_coinbase_collector())
+
+
+async def stop_coinbase_collector() -> None:
+    global _collector_task
+    if _collector_task is not None:
+        _collector_task.cancel()
+        try:
+            await _collector_task
+        except asyncio.CancelledError:
+            pass
+        _collector_task = None
+    await crypto_futures_writer.stop()
+
+
+CallbackCounter('finance_api_coinbase_collector_events_total', 'Coinbase websocket collector counters since startup.', ('event',), lambda: {(name,): _collector_stats[name] for name in ('connects', 'reconnects', 'messages', 'ticks', 'message_errors')})
+CallbackGauge('finance_api_coinbase_quote_age_seconds', 'Seconds since each product last ticked.', ('product_id',), lambda: {(product_id,): round(time.time() - accumulator.last_tick_at, 3) if accumulator.last_tick_at is not None else None for product_id, accumulator in _accumulators.items()})
+
+
+def get_coinbase_collector_stats() -> dict:
+    return {**_collector_stats, 'products': {product_id: accumulator.stats() for product_id, accumulator in _accumulators.items()}, 'postgres_writer': crypto_futures_writer.stats()}
+
+
+def get_crypto_basis_stats(coin_ticker: str, window_seconds: float) -> dict:
+    """
+    Rolling quote and perp-vs-spot basis statistics for a coin over the most recent window_seconds of collected ticks.
+
+    :param coin_ticker: Key of COINBASE_PRODUCT_PAIRS (e.g., 'btc').
+    :param window_seconds: How far back to look. Limited to what the ring buffers still hold.
+    :return: Spot and perp mid/spread stats and the basis between them.
+    """
+    from tick_store import get_quote_stats, get_basis_stats
+    spot_product_id, perp_product_id = COINBASE_PRODUCT_PAIRS[coin_ticker]
+    start_time = time.time() - window_seconds
+    spot_ticks = _accumulators[spot_product_id].tick_buffer.window(start_time)
+    perp_ticks = _accumulators[perp_product_id].tick_buffer.window(start_time)
+    return {
+        'coin': coin_ticker,
+        'window_seconds': window_seconds,
+        'spot': {'product_id': spot_product_id, **get_quote_stats(spot_ticks)},
+        'perp': {'product_id': perp_product_id, **get_quote_stats(perp_ticks)},
+        'basis': get_basis_stats(spot_ticks, perp_ticks),
+    }
 
 
 @router.post("/write-crypto-futures-data", status_code=200)
@@ -58,33 +267,54 @@ async def write_crypto_futures_data(response: Response, token: Annotated[str | N
         if not authorized_via_finance_token(token):
             response.status_code = status.HTTP_401_UNAUTHORIZED
             return ''
-    
-        btc = DefaultDict(float)
-        eth = DefaultDict(float)
-        
-        api_credentials = get_coinbase_api_credentials()
-
-        client = WSClient(api_key=api_credentials[0], api_secret=api_credentials[1], on_message=on_message)
 
-        # open the connection and subscribe to the ticker and heartbeat channels for BTC-USD and ETH-USD
-        client.open()
-        client.subscribe(product_ids=["BTC-PERP-INTX", "BTC-USD", "ETH-PERP-INTX", "ETH-USD"], channels=["ticker"])
+        # The collector has been averaging ticks since the last call, so this is just a snapshot of what it has
+        snapshot = take_coinbase_snapshot()
+        written = 0
+        for coin_ticker, (spot_product_id, perp_product_id) in COINBASE_PRODUCT_PAIRS.items():
+            spot, perp = snapshot.get(spot_product_id), snapshot.get(perp_product_id)
+            if spot is None or perp is None or max(spot['age_seconds'], perp['age_seconds']) > COINBASE_MAX_QUOTE_AGE_SECONDS:
+                append_to_log('ERROR', f'No recent Coinbase quotes for {spot_product_id} and {perp_product_id}, skipping {coin_ticker}.')
+                continue
+            # Buffered, the writer COPYs it to Postgres with the next batch
+            crypto_futures_writer.add(get_crypto_futures_table(coin_ticker), (get_epoch_time(), get_postgres_timestamp_now(), spot['bid'], spot['ask'], perp['bid'], perp['ask']))
+            written += 1
 
-        # wait 3 seconds
-        time.sleep(3)
-
-        # unsubscribe from the ticker channel and heartbeat channels for BTC-USD and ETH-USD, and close the connection
-        client.unsubscribe(product_ids=["BTC-PERP-INTX", "BTC-USD", "ETH-PERP-INTX", "ETH-USD"], channels=["ticker"])
-        client.close()
+        if written == 0:
+            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            return ''
 
-        write_crypto_future_data_to_postgres('btc', btc['spot_bid'] / btc['spot_count'], btc['spot_ask'] / btc['spot_count'], btc['perp_bid'] / btc['perp_count'], btc['perp_ask'] / btc['perp_count'])
-        write_crypto_future_data_to_postgres('eth', eth['spot_bid'] / eth['spot_count'], eth['spot_ask'] / eth['spot_count'], eth['perp_bid'] / eth['perp_count'], eth['perp_ask'] / eth['perp_count'])
-        
-        await append_to_log('DEBUG', 'Finished writing coinbase data to logs.')
+        append_to_log('DEBUG', 'Queued coinbase data for Postgres.')
         return ''
 
     except Exception as e:
-        await append_to_log('ERROR', repr(e))
+        append_to_log('ERROR', repr(e))
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return ''
-      
+
+
+@router.get("/crypto-basis-stats", status_code=200)
+async def crypto_basis_stats(response: Response, coin: str = Query(..., description="Coin ticker, e.g. btc"), window_seconds: float = Query(COINBASE_BASIS_DEFAULT_WINDOW_SECONDS, description="Seconds of ticks to include"), token: Annotated[str | None, Header()] = None):
+    try:
+        if not authorized_via_finance_token(token):
+            response.status_code = status.HTTP_401_UNAUTHORIZED
+            return {}
+
+        coin = coin.strip().lower()
+        if coin not in COINBASE_PRODUCT_PAIRS or window_seconds <= 0:
+            append_to_log('ERROR', f'Bad crypto basis stats request. Coin: {coin}, Window: {window_seconds}')
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {}
+
+        if not _accumulators:
+            # Only in the moment between startup and the collector creating its tick buffers
+            response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+            return {}
+
+        # Copying and crunching a large window takes a few milliseconds, keep it off the event loop
+        return await asyncio.to_thread(get_crypto_basis_stats, coin, window_seconds)
+
+    except Exception as e:
+        append_to_log('ERROR', f'Exception in crypto_basis_stats: {repr(e)}')
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return {}
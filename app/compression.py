@@ -0,0 +1,66 @@
+from fastapi import Request, Response, status
+import gzip
+import json
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+# Bodies smaller than this aren't worth the CPU to compress
+MIN_COMPRESSION_BYTES = 1024
+GZIP_COMPRESSION_LEVEL = 6
+BROTLI_COMPRESSION_QUALITY = 5
+
+
+def get_accepted_encodings(request: Request) -> set:
+    # e.g. "gzip, deflate, br;q=0.9" -> {'gzip', 'deflate', 'br'}. Encodings with q=0 are refused by the client.
+    accepted = set()
+    for part in request.headers.get('accept-encoding', '').split(','):
+        fields = [field.strip() for field in part.split(';')]
+        if fields[0] and not any(field.replace(' ', '') in ('q=0', 'q=0.0') for field in fields[1:]):
+            accepted.add(fields[0].lower())
+    return accepted
+
+
+def strip_weak_prefix(etag: str) -> str:
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so W/"x" and "x" match each other
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    candidates = [strip_weak_prefix(candidate.strip()) for candidate in if_none_match.split(',')]
+    return '*' in candidates or strip_weak_prefix(etag) in candidates
+
+
+def build_json_response(request: Request, content: dict, etag: str = None) -> Response:
+    """
+    Builds a JSON response that honours If-None-Match and compresses with br or gzip when the client accepts it.
+
+    :param request: The incoming request, for its If-None-Match and Accept-Encoding headers.
+    :param content: The JSON body.
+    :param etag: Entity tag for the content (e.g., 'W/"3f2a..."'). It should be weak since the same tag is sent whichever
+        encoding the body ends up in. No ETag handling when None.
+    :return: A 304 when the client's copy is current, otherwise the (possibly compressed) JSON response.
+    """
+    headers = {'Vary': 'Accept-Encoding'}
+    if etag is not None:
+        headers['ETag'] = etag
+        if etag_matches(request, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Same serialization FastAPI's JSONResponse uses, without going through jsonable_encoder
+    body = json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+    if len(body) >= MIN_COMPRESSION_BYTES:
+        accepted_encodings = get_accepted_encodings(request)
+        if BROTLI_AVAILABLE and 'br' in accepted_encodings:
+            body = brotli.compress(body, quality=BROTLI_COMPRESSION_QUALITY)
+            headers['Content-Encoding'] = 'br'
+        elif 'gzip' in accepted_encodings:
+            body = gzip.compress(body, compresslevel=GZIP_COMPRESSION_LEVEL)
+            headers['Content-Encoding'] = 'gzip'
+    return Response(content=body, media_type='application/json', headers=headers)
@@ -0,0 +1,102 @@
+import httpx
+import time
+from metrics import upstream_request_duration, upstream_requests
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# One pooled client per upstream host. HTTP/2 is negotiated through ALPN, so hosts that
+# don't offer it transparently fall back to HTTP/1.1 keep-alive connections.
+UPSTREAMS = {
+    'alpha_vantage': {'host': 'www.alphavantage.co', 'timeout': 10.0, 'max_connections': 10, 'max_keepalive_connections': 5},
+    'gurufocus': {'host': 'www.gurufocus.com', 'timeout': 15.0, 'max_connections': 20, 'max_keepalive_connections': 10},
+    'api_ninjas': {'host': 'api.api-ninjas.com', 'timeout': 30.0, 'max_connections': 5, 'max_keepalive_connections': 5},
+    'logging': {'host': 'cjremmett.com', 'timeout': 10.0, 'max_connections': 10, 'max_keepalive_connections': 10},
+}
+CONNECT_TIMEOUT_SECONDS = 5.0
+KEEPALIVE_EXPIRY_SECONDS = 30.0
+
+_clients = {}
+_request_counts = {}
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    """
+    The default pooled transport, timing every request to its response headers and counting outcomes per upstream.
+    Unlike response event hooks this also sees requests that fail with a transport error (timeouts, resets).
+    """
+
+    def __init__(self, upstream: str, **kwargs):
+        super().__init__(**kwargs)
+        self.upstream = upstream
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        counts = _request_counts[self.upstream]
+        counts['requests'] += 1
+        host = request.url.host
+        start = time.monotonic()
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            counts['transport_errors'] += 1
+            upstream_request_duration.observe((self.upstream, host), time.monotonic() - start)
+            upstream_requests.inc((self.upstream, host, 'transport_error'))
+            raise
+        upstream_request_duration.observe((self.upstream, host), time.monotonic() - start)
+        if response.status_code >= 400:
+            counts['error_responses'] += 1
+            upstream_requests.inc((self.upstream, host, 'error_status'))
+        else:
+            upstream_requests.inc((self.upstream, host, 'ok'))
+        return response
+
+
+def create_http_client(upstream: str) -> httpx.AsyncClient:
+    config = UPSTREAMS[upstream]
+    _request_counts.setdefault(upstream, {'requests': 0, 'error_responses': 0, 'transport_errors': 0})
+    # With a custom transport the pool settings go on the transport rather than the client
+    transport = InstrumentedTransport(
+        upstream,
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_connections=config['max_connections'], max_keepalive_connections=config['max_keepalive_connections'], keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS),
+    )
+    return httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(config['timeout'], connect=CONNECT_TIMEOUT_SECONDS))
+
+
+def create_http_clients() -> None:
+    # Called from the app lifespan so every upstream has a warm pool before the first request
+    for upstream in UPSTREAMS:
+        if upstream not in _clients:
+            _clients[upstream] = create_http_client(upstream)
+
+
+def get_http_client(upstream: str) -> httpx.AsyncClient:
+    # Falls back to creating the client on first use so code running outside the lifespan still works
+    client = _clients.get(upstream)
+    if client is None or client.is_closed:
+        client = create_http_client(upstream)
+        _clients[upstream] = client
+    return client
+
+
+async def close_http_clients() -> None:
+    for upstream in list(_clients):
+        await _clients.pop(upstream).aclose()
+
+
+def get_http_pool_stats() -> dict:
+    stats = {}
+    for upstream, config in UPSTREAMS.items():
+        upstream_stats = {'host': config['host'], 'http2_enabled': HTTP2_AVAILABLE, 'max_connections': config['max_connections'], **_request_counts.get(upstream, {'requests': 0, 'error_responses': 0, 'transport_errors': 0})}
+        client = _clients.get(upstream)
+        # httpx doesn't expose its pool publicly, so read it off the transport when it's the default httpcore pool
+        connections = getattr(getattr(getattr(client, '_transport', None), '_pool', None), 'connections', None)
+        if connections is not None:
+            upstream_stats['open_connections'] = len(connections)
+            upstream_stats['idle_connections'] = sum(1 for connection in connections if connection.is_idle())
+            upstream_stats['http2_connections'] = sum(1 for connection in connections if 'HTTP/2' in connection.info())
+        stats[upstream] = upstream_stats
+    return stats
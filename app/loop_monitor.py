@@ -0,0 +1,171 @@
+import asyncio
+import functools
+import importlib
+import os
+import sys
+import threading
+import time
+import traceback
+from utils import append_to_log
+from metrics import Counter, Histogram
+
+# A heartbeat coroutine sleeps for LOOP_LAG_SAMPLE_INTERVAL_SECONDS and records how late it woke up. Lateness means
+# something held the event loop, and every request in flight waited for it.
+# A watchdog thread checks the heartbeat; once it is more than LOOP_BLOCKED_THRESHOLD_SECONDS overdue the loop thread's
+# current stack is logged, which is the code doing the blocking.
+LOOP_LAG_SAMPLE_INTERVAL_SECONDS = 0.1
+LOOP_BLOCKED_THRESHOLD_SECONDS = 0.25
+LOOP_WATCHDOG_INTERVAL_SECONDS = 0.05
+LOOP_STACK_MAX_FRAMES = 30
+LOOP_LAG_BUCKETS_SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Strict mode (FINANCE_API_LOOP_DEBUG=1) is for development and load tests, not production. It turns on asyncio's debug
+# mode and wraps the calls below so any of them made on the event loop thread is logged with its call site.
+# Calls from worker threads (asyncio.to_thread, the Coinbase websocket thread) are fine and not reported.
+LOOP_DEBUG = os.environ.get('FINANCE_API_LOOP_DEBUG', '') == '1'
+KNOWN_BLOCKING_CALLS = [
+    ('time', 'sleep'),
+    ('socket', 'getaddrinfo'),
+    ('socket', 'create_connection'),
+    ('redis', 'Redis.execute_command'),
+    ('sqlalchemy.engine', 'Engine.connect'),
+    ('sqlalchemy.engine', 'Engine.raw_connection'),
+    ('psycopg2', 'connect'),
+    ('pymongo', 'MongoClient.__init__'),
+    ('requests', 'Session.request'),
+    ('subprocess', 'run'),
+]
+
+event_loop_lag = Histogram('finance_api_event_loop_lag_seconds', 'How late the event loop heartbeat woke up.', buckets=LOOP_LAG_BUCKETS_SECONDS)
+event_loop_blocked = Counter('finance_api_event_loop_blocked_total', 'Times the event loop was held longer than the blocked threshold.')
+blocking_calls = Counter('finance_api_blocking_calls_total', 'Known blocking calls made on the event loop thread (strict mode only).', ('call',))
+
+_loop_thread_id = None
+_last_heartbeat = 0.0
+_heartbeat_task = None
+_watchdog_thread = None
+_watchdog_stop = threading.Event()
+_reported_call_sites = set()
+_original_calls = {}
+_loop_stats = {'samples': 0, 'max_lag_seconds': 0.0, 'blocked': 0, 'last_blocked_at': None, 'last_blocked_stack': None, 'blocking_calls': 0}
+
+
+def format_stack(frame) -> str:
+    return ''.join(traceback.format_stack(frame, limit=LOOP_STACK_MAX_FRAMES))
+
+
+async def run_loop_heartbeat() -> None:
+    global _last_heartbeat
+    while True:
+        expected = time.monotonic() + LOOP_LAG_SAMPLE_INTERVAL_SECONDS
+        await asyncio.sleep(LOOP_LAG_SAMPLE_INTERVAL_SECONDS)
+        now = time.monotonic()
+        _last_heartbeat = now
+        lag = max(0.0, now - expected)
+        event_loop_lag.observe((), lag)
+        _loop_stats['samples'] += 1
+        _loop_stats['max_lag_seconds'] = max(_loop_stats['max_lag_seconds'], lag)
+
+
+def run_loop_watchdog() -> None:
+    # Reports each stall once, with the stack from when it crossed the threshold
+    reported_heartbeat = None
+    while not _watchdog_stop.wait(LOOP_WATCHDOG_INTERVAL_SECONDS):
+        heartbeat = _last_heartbeat
+        overdue = time.monotonic() - heartbeat - LOOP_LAG_SAMPLE_INTERVAL_SECONDS
+        if overdue < LOOP_BLOCKED_THRESHOLD_SECONDS or heartbeat == reported_heartbeat:
+            continue
+        reported_heartbeat = heartbeat
+        frame = sys._current_frames().get(_loop_thread_id)
+        stack = format_stack(frame) if frame is not None else 'unavailable'
+        event_loop_blocked.inc()
+        _loop_stats['blocked'] += 1
+        _loop_stats['last_blocked_at'] = time.time()
+        _loop_stats['last_blocked_stack'] = stack
+        append_to_log('WARNING', f'Event loop blocked for over {overdue:.3f} seconds, loop thread stack:\n{stack}')
+
+
+def resolve_attribute(module_name: str, attribute_path: str) -> tuple:
+    # Returns (owner, attribute name) for e.g. ('redis', 'Redis.execute_command'), or None if the module isn't installed
+    try:
+        owner = importlib.import_module(module_name)
+    except ImportError:
+        return None
+    *owner_path, attribute = attribute_path.split('.')
+    for name in owner_path:
+        owner = getattr(owner, name)
+    return owner, attribute
+
+
+def wrap_blocking_call(call_name: str, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if threading.get_ident() == _loop_thread_id:
+            report_blocking_call(call_name)
+        return function(*args, **kwargs)
+    return wrapper
+
+
+def report_blocking_call(call_name: str) -> None:
+    blocking_calls.inc((call_name,))
+    _loop_stats['blocking_calls'] += 1
+    # Skip this function and the wrapper so the call site is the last frame
+    frame = sys._getframe(2)
+    call_site = (call_name, frame.f_code.co_filename, frame.f_lineno)
+    if call_site not in _reported_call_sites:
+        _reported_call_sites.add(call_site)
+        append_to_log('WARNING', f'Blocking call {call_name} made on the event loop thread:\n{format_stack(frame)}')
+
+
+def install_blocking_call_checks() -> None:
+    for module_name, attribute_path in KNOWN_BLOCKING_CALLS:
+        call_name = f'{module_name}.{attribute_path}'
+        if call_name in _original_calls:
+            continue
+        try:
+            resolved = resolve_attribute(module_name, attribute_path)
+        except AttributeError:
+            resolved = None
+        if resolved is None:
+            continue
+        owner, attribute = resolved
+        _original_calls[call_name] = (owner, attribute, getattr(owner, attribute))
+        setattr(owner, attribute, wrap_blocking_call(call_name, getattr(owner, attribute)))
+
+
+def remove_blocking_call_checks() -> None:
+    for owner, attribute, function in _original_calls.values():
+        setattr(owner, attribute, function)
+    _original_calls.clear()
+
+
+def start_loop_monitor(strict: bool = LOOP_DEBUG) -> None:
+    # Called from the app lifespan, on the loop being monitored
+    global _loop_thread_id, _last_heartbeat, _heartbeat_task, _watchdog_thread
+    loop = asyncio.get_running_loop()
+    _loop_thread_id = threading.get_ident()
+    _last_heartbeat = time.monotonic()
+    _heartbeat_task = asyncio.create_task(run_loop_heartbeat())
+    _watchdog_stop.clear()
+    _watchdog_thread = threading.Thread(target=run_loop_watchdog, name='loop-watchdog', daemon=True)
+    _watchdog_thread.start()
+    if strict:
+        # asyncio then also logs any single callback slower than the threshold through the asyncio logger
+        loop.set_debug(True)
+        loop.slow_callback_duration = LOOP_BLOCKED_THRESHOLD_SECONDS
+        install_blocking_call_checks()
+        append_to_log('INFO', f'Event loop strict mode on, checking {len(_original_calls)} known blocking calls.')
+
+
+def stop_loop_monitor() -> None:
+    global _heartbeat_task, _watchdog_thread
+    if _heartbeat_task is not None:
+        _heartbeat_task.cancel()
+        _heartbeat_task = None
+    _watchdog_stop.set()
+    _watchdog_thread = None
+    remove_blocking_call_checks()
+
+
+def get_loop_monitor_stats() -> dict:
+    return {**_loop_stats, 'strict': bool(_original_calls), 'threshold_seconds': LOOP_BLOCKED_THRESHOLD_SECONDS, 'seconds_since_heartbeat': time.monotonic() - _last_heartbeat}
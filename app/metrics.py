@@ -0,0 +1,140 @@
+import bisect
+import threading
+
+# In-process counters and histograms rendered in the Prometheus text format by /metrics.
+# Observations come from the event loop and from worker threads (Postgres, the Coinbase websocket), so each metric has a lock.
+LATENCY_BUCKETS_SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics = []
+
+
+def format_labels(label_names: tuple, labels: tuple) -> str:
+    if not label_names:
+        return ''
+    escaped = [str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(label_names, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in self.values.items():
+                lines.append(f'{self.name}{format_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS_SECONDS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels -> [per-bucket counts with a final +Inf slot, sum, count]
+        self.series = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, labels: tuple, value: float) -> None:
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.series[labels] = series
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, (bucket_counts, total, count) in self.series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{format_labels(self.label_names + ("le",), labels + (bound,))} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {total}')
+                lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {count}')
+        return lines
+
+
+class CallbackGauge:
+    """
+    A gauge read at scrape time. collect() returns {labels: value}, so existing stats dicts can be exported without
+    touching the code that keeps them.
+    """
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, help_text: str, label_names: tuple, collect):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.collectors = [collect]
+        _metrics.append(self)
+
+    def add_collector(self, collect) -> None:
+        self.collectors.append(collect)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.metric_type}']
+        for collect in self.collectors:
+            for labels, value in collect().items():
+                if value is not None:
+                    lines.append(f'{self.name}{format_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+class CallbackCounter(CallbackGauge):
+    """
+    A counter read at scrape time, for stats dicts that only ever count up from startup. Name it with the _total suffix.
+    """
+    metric_type = 'counter'
+
+
+http_request_duration = Histogram('finance_api_http_request_duration_seconds', 'Time to respond to API requests.', ('router', 'route', 'method', 'status'))
+upstream_request_duration = Histogram('finance_api_upstream_request_duration_seconds', 'Time until response headers from upstream hosts.', ('upstream', 'host'))
+upstream_requests = Counter('finance_api_upstream_requests_total', 'Upstream requests by outcome (ok, error_status, transport_error).', ('upstream', 'host', 'outcome'))
+dependency_call_duration = Histogram('finance_api_dependency_call_duration_seconds', 'Redis, Mongo and Postgres call timings.', ('system', 'operation'))
+dependency_errors = Counter('finance_api_dependency_errors_total', 'Failed Redis, Mongo and Postgres calls.', ('system', 'operation'))
+cache_requests = CallbackCounter('finance_api_cache_requests_total', 'Cache lookups since startup by result.', ('cache', 'result'), lambda: {})
+cache_hit_ratio = CallbackGauge('finance_api_cache_hit_ratio', 'Share of cache lookups served from the cache.', ('cache',), lambda: {})
+
+
+def observe_dependency_call(system: str, operation: str, seconds: float, failed: bool = False) -> None:
+    dependency_call_duration.observe((system, operation), seconds)
+    if failed:
+        dependency_errors.inc((system, operation))
+
+
+def register_cache(name: str, stats) -> None:
+    # stats() returns a dict with at least hits and misses, like TTLCache.stats. Two-tier caches also split hits by tier.
+    def collect_requests() -> dict:
+        cache_stats = stats()
+        return {(name, result): cache_stats[result] for result in ('hits', 'misses', 'stale_served', 'l1_hits', 'l2_hits', 'lock_waits') if result in cache_stats}
+
+    def collect_ratio() -> dict:
+        cache_stats = stats()
+        lookups = cache_stats['hits'] + cache_stats['misses']
+        return {(name,): round(cache_stats['hits'] / lookups, 4) if lookups else None}
+
+    cache_requests.add_collector(collect_requests)
+    cache_hit_ratio.add_collector(collect_ratio)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,141 @@
+import asyncio
+import collections
+import csv
+import functools
+import io
+import time
+from utils import append_to_log, checkout_postgres_connection
+from metrics import observe_dependency_call
+
+# Rows are buffered per table and written with COPY FROM STDIN in batches, from a worker thread on a connection from the database's pool.
+# A batch that fails goes back to the front of its buffer and is retried with backoff, so an outage only delays rows.
+# If an outage outlasts POSTGRES_WRITER_MAX_BUFFERED_ROWS the oldest rows are dropped and counted.
+POSTGRES_WRITER_BATCH_SIZE = 500
+POSTGRES_WRITER_FLUSH_INTERVAL_SECONDS = 5.0
+POSTGRES_WRITER_MAX_BUFFERED_ROWS = 100000
+POSTGRES_WRITER_RETRY_MIN_SECONDS = 1.0
+POSTGRES_WRITER_RETRY_MAX_SECONDS = 60.0
+POSTGRES_WRITER_SHUTDOWN_FLUSH_TIMEOUT_SECONDS = 10.0
+
+
+class BufferedPostgresWriter:
+    """
+    Buffers rows for registered tables and flushes them once a table has POSTGRES_WRITER_BATCH_SIZE rows waiting
+    or every POSTGRES_WRITER_FLUSH_INTERVAL_SECONDS. add is only called from the event loop.
+    """
+
+    def __init__(self, database: str):
+        self.database = database
+        self.tables = {}
+        self.flush_event = None
+        self.task = None
+        self.stopping = False
+        # The COPY most recently handed to a worker thread
+        self.copy_task = None
+        self.retry_delay = 0.0
+        self.counts = {'buffered': 0, 'written': 0, 'batches': 0, 'failed_batches': 0, 'dropped': 0}
+
+    def register_table(self, table: str, columns: list, column_definitions: str) -> None:
+        # column_definitions is used for CREATE TABLE IF NOT EXISTS before the first COPY into the table
+        if table not in self.tables:
+            self.tables[table] = {'columns': columns, 'column_definitions': column_definitions, 'provisioned': False, 'rows': collections.deque()}
+
+    def add(self, table: str, row: tuple) -> None:
+        rows = self.tables[table]['rows']
+        rows.append(row)
+        self.counts['buffered'] += 1
+        if sum(len(entry['rows']) for entry in self.tables.values()) > POSTGRES_WRITER_MAX_BUFFERED_ROWS:
+            rows.popleft()
+            self.counts['dropped'] += 1
+        if len(rows) >= POSTGRES_WRITER_BATCH_SIZE and self.flush_event is not None:
+            self.flush_event.set()
+
+    def copy_rows(self, table: str, rows: list) -> None:
+        # Runs in a worker thread. The COPY is one transaction, so a batch is either all written or not at all.
+        entry = self.tables[table]
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+        connection = checkout_postgres_connection(self.database, raw=True)
+        # A raw psycopg2 cursor bypasses the engine's statement timing, so the COPY is timed here
+        start = time.monotonic()
+        try:
+            with connection.cursor() as cursor:
+                if not entry['provisioned']:
+                    cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} ({entry["column_definitions"]})')
+                cursor.copy_expert(f'COPY {table} ({", ".join(entry["columns"])}) FROM STDIN WITH (FORMAT csv)', data)
+            connection.commit()
+            entry['provisioned'] = True
+            observe_dependency_call('postgres', 'copy', time.monotonic() - start)
+        except Exception:
+            observe_dependency_call('postgres', 'copy', time.monotonic() - start, failed=True)
+            connection.rollback()
+            raise
+        finally:
+            # Returns the connection to the engine's pool
+            connection.close()
+
+    def settle_copy(self, rows: collections.deque, batch: list, copy_task: asyncio.Future) -> None:
+        if copy_task.cancelled() or copy_task.exception() is not None:
+            # Back in front of anything added meanwhile, in the original order
+            rows.extendleft(reversed(batch))
+            self.counts['failed_batches'] += 1
+        else:
+            self.counts['written'] += len(batch)
+            self.counts['batches'] += 1
+
+    async def flush(self) -> None:
+        for table, entry in self.tables.items():
+            rows = entry['rows']
+            while rows:
+                batch = [rows.popleft() for _ in range(min(POSTGRES_WRITER_BATCH_SIZE, len(rows)))]
+                # Cancelling flush can't stop the COPY thread, so the batch is settled when the thread finishes rather
+                # than when flush stops waiting for it. Raises if the COPY failed.
+                self.copy_task = asyncio.ensure_future(asyncio.to_thread(self.copy_rows, table, batch))
+                self.copy_task.add_done_callback(functools.partial(self.settle_copy, rows, batch))
+                await asyncio.shield(self.copy_task)
+
+    async def run(self) -> None:
+        # Exits after the flush that follows stop() setting stopping
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), timeout=POSTGRES_WRITER_FLUSH_INTERVAL_SECONDS + self.retry_delay)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            try:
+                await self.flush()
+                self.retry_delay = 0.0
+            except Exception as e:
+                self.retry_delay = min(POSTGRES_WRITER_RETRY_MAX_SECONDS, max(POSTGRES_WRITER_RETRY_MIN_SECONDS, self.retry_delay * 2))
+                append_to_log('ERROR', f'Writing buffered rows to Postgres database {self.database} failed, retrying in {self.retry_delay} seconds: {repr(e)}')
+            if self.stopping:
+                return
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.stopping = False
+            self.flush_event = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        # Write out whatever is still buffered so shutdown doesn't lose it. The run loop is woken to do a last flush
+        # rather than cancelled, so a batch it's in the middle of isn't abandoned.
+        if self.task is not None and not self.task.done():
+            self.stopping = True
+            self.flush_event.set()
+            final_flush = self.task
+        else:
+            final_flush = self.flush()
+        try:
+            await asyncio.wait_for(final_flush, timeout=POSTGRES_WRITER_SHUTDOWN_FLUSH_TIMEOUT_SECONDS)
+        except Exception as e:
+            append_to_log('ERROR', f'Failed to flush buffered rows to Postgres database {self.database} on shutdown: {repr(e)}')
+        self.task = None
+
+        # A timed out flush leaves its COPY running in the worker thread. Wait for it so the engine isn't disposed under it.
+        if self.copy_task is not None and not self.copy_task.done():
+            await asyncio.wait({self.copy_task})
+
+    def stats(self) -> dict:
+        return {**self.counts, 'pending': {table: len(entry['rows']) for table, entry in self.tables.items()}, 'retry_delay_seconds': self.retry_delay}
@@ -0,0 +1,135 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+# Samples kept per source for routing decisions. Until a source has MIN_SAMPLES the
+# default hedge delay is used and sources keep the order they were registered in.
+LATENCY_WINDOW = 200
+OUTCOME_WINDOW = 50
+MIN_SAMPLES = 10
+DEFAULT_HEDGE_DELAY_SECONDS = 2.0
+MIN_HEDGE_DELAY_SECONDS = 0.25
+MAX_HEDGE_DELAY_SECONDS = 5.0
+MIN_SUCCESS_RATE = 0.05
+
+
+class QuoteSource:
+    """
+    A named quote fetcher. fetch(ticker) returns (price, market_cap) and raises when it can't.
+    supports(ticker) says whether the source can serve the ticker at all.
+    hedge_fetch(ticker), if given, is used instead of fetch when the source races another one as a hedge, e.g. to
+    send the request at a lower priority against a rate limited quota.
+    """
+
+    def __init__(self, name: str, fetch: Callable[[str], Awaitable[tuple]], supports: Callable[[str], bool] = lambda ticker: True, hedge_fetch: Callable[[str], Awaitable[tuple]] = None):
+        self.name = name
+        self.fetch = fetch
+        self.supports = supports
+        self.hedge_fetch = hedge_fetch or fetch
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.outcomes = deque(maxlen=OUTCOME_WINDOW)
+        # hedges race a request still running, fallbacks are sent after every earlier request failed
+        self.counts = {'requests': 0, 'successes': 0, 'failures': 0, 'cancelled': 0, 'hedges': 0, 'fallbacks': 0}
+
+    def latency_percentile(self, percentile: float) -> float:
+        if len(self.latencies) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(percentile * len(ordered)))]
+
+    def success_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 1.0
+
+    def hedge_delay(self) -> float:
+        # Send the backup request once the primary is slower than its own p95
+        p95 = self.latency_percentile(0.95)
+        if p95 == None:
+            return DEFAULT_HEDGE_DELAY_SECONDS
+        return min(MAX_HEDGE_DELAY_SECONDS, max(MIN_HEDGE_DELAY_SECONDS, p95))
+
+    def score(self) -> float:
+        # Expected time to a good answer, lower is better. Sources without enough samples score 0 and keep registration order.
+        p50 = self.latency_percentile(0.5)
+        if p50 == None:
+            return 0.0
+        return p50 / max(MIN_SUCCESS_RATE, self.success_rate())
+
+    def stats(self) -> dict:
+        return {**self.counts, 'p50_seconds': self.latency_percentile(0.5), 'p95_seconds': self.latency_percentile(0.95), 'success_rate': round(self.success_rate(), 3), 'hedge_delay_seconds': self.hedge_delay()}
+
+
+class HedgedQuoteEngine:
+    """
+    Routes each quote to the source with the best recent latency and success rate. If the primary
+    hasn't answered within its p95 (or fails), the next source is tried too and the first valid answer wins.
+    """
+
+    def __init__(self, sources: list):
+        self.sources = sources
+
+    def rank_sources(self, ticker: str) -> list:
+        return sorted([source for source in self.sources if source.supports(ticker)], key=lambda source: source.score())
+
+    async def timed_fetch(self, source: QuoteSource, ticker: str, hedge: bool = False) -> tuple:
+        source.counts['requests'] += 1
+        start = time.monotonic()
+        try:
+            result = await (source.hedge_fetch(ticker) if hedge else source.fetch(ticker))
+        except asyncio.CancelledError:
+            # The loser of a hedge is still at least this slow, so keep the sample or a slow source would never look slow
+            source.counts['cancelled'] += 1
+            source.latencies.append(time.monotonic() - start)
+            raise
+        except Exception:
+            source.counts['failures'] += 1
+            source.outcomes.append(0)
+            raise
+        source.counts['successes'] += 1
+        source.outcomes.append(1)
+        source.latencies.append(time.monotonic() - start)
+        return result
+
+    async def get_quote(self, ticker: str) -> tuple:
+        """
+        Returns (price, market_cap) for ticker from whichever source answers first.
+
+        :param ticker: The stock ticker symbol (e.g., 'LVS' or 'MIC:SBER').
+        :return: The first valid (price, market_cap) tuple.
+        :raises Exception: If no source supports the ticker or every source tried failed.
+        """
+        candidates = self.rank_sources(ticker)
+        if not candidates:
+            raise Exception(f'No quote source supports ticker {ticker}.')
+
+        primary = candidates[0]
+        tasks = {asyncio.create_task(self.timed_fetch(primary, ticker))}
+        backups = iter(candidates[1:])
+        last_exception = None
+        try:
+            timeout = primary.hedge_delay()
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() == None:
+                        return task.result()
+                    last_exception = task.exception()
+
+                # Either the primary is past its p95 or something failed, so bring in the next source
+                backup = next(backups, None)
+                if backup != None:
+                    # Only a hedge if it races a request still running, otherwise it's the fallback and the only fetch left
+                    hedge = bool(tasks)
+                    backup.counts['hedges' if hedge else 'fallbacks'] += 1
+                    tasks.add(asyncio.create_task(self.timed_fetch(backup, ticker, hedge=hedge)))
+                elif not done:
+                    # Nothing left to hedge with, just wait for whatever is still running
+                    timeout = None
+
+            raise last_exception
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {source.name: source.stats() for source in self.sources}
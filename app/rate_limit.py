@@ -0,0 +1,110 @@
+import asyncio
+import datetime
+import time
+from shared_cache import call_redis
+
+DAILY_QUOTA_KEY_PREFIX = 'finance-api:quota:'
+# Counters outlive their day by this much so a worker with a slightly slow clock doesn't start a fresh count
+DAILY_QUOTA_EXPIRY_MARGIN_SECONDS = 3600
+
+
+class TokenBucket:
+    """
+    Token bucket holding up to capacity tokens, refilled evenly over refill_period_seconds.
+    """
+
+    def __init__(self, capacity: int, refill_period_seconds: float):
+        self.capacity = capacity
+        self.refill_per_second = capacity / refill_period_seconds
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.refill_per_second)
+        self._updated_at = now
+
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def seconds_until_available(self) -> float:
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.refill_per_second
+
+    def take(self) -> None:
+        self._refill()
+        self._tokens -= 1
+
+    def drain(self) -> None:
+        # The upstream says we're over its limit, so trust it over our own count
+        self._refill()
+        self._tokens = min(self._tokens, 0.0)
+
+    async def acquire(self) -> None:
+        # Waits until a token is free and takes it
+        while self.seconds_until_available() > 0:
+            await asyncio.sleep(self.seconds_until_available())
+        self.take()
+
+
+class DailyQuota:
+    """
+    Up to limit calls per day, counted in a fixed window that resets at midnight in reset_timezone (the provider's day
+    boundary) rather than refilling continuously. The count is kept in Redis through the shared cache client, so every
+    worker and container draws on the same quota. While Redis is unavailable each process counts on its own.
+    """
+
+    def __init__(self, name: str, limit: int, reset_timezone: datetime.tzinfo = datetime.timezone.utc):
+        self.name = name
+        self.limit = limit
+        self.reset_timezone = reset_timezone
+        # The fallback count, and the last count seen either way, as (day, count)
+        self._local_count = (None, 0)
+        self._last_seen = (None, 0)
+
+    def current_window(self) -> tuple:
+        # (day, epoch time of the next reset), e.g. ('2025-08-05', 1754438400.0)
+        now = datetime.datetime.now(self.reset_timezone)
+        next_reset = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(), tzinfo=self.reset_timezone)
+        return now.date().isoformat(), next_reset.timestamp()
+
+    def remaining(self, limit: int = None) -> int:
+        # From the last count this process saw, so another worker's calls since then aren't included
+        limit = self.limit if limit is None else limit
+        day, _ = self.current_window()
+        last_day, used = self._last_seen
+        return max(0, limit - (used if last_day == day else 0))
+
+    async def try_take(self, limit: int = None) -> bool:
+        """
+        Takes one call from today's quota if fewer than limit have been used.
+
+        :param limit: Defaults to the whole quota. A lower limit keeps the rest in reserve for callers using a higher one.
+        :return: Whether the call was taken.
+        """
+        limit = self.limit if limit is None else limit
+        day, resets_at = self.current_window()
+        key = f'{DAILY_QUOTA_KEY_PREFIX}{self.name}:{day}'
+
+        used = await call_redis('incr', lambda client: client.incr(key))
+        shared = used is not None
+        if shared:
+            if used == 1:
+                await call_redis('expireat', lambda client: client.expireat(key, int(resets_at) + DAILY_QUOTA_EXPIRY_MARGIN_SECONDS))
+        else:
+            local_day, local_used = self._local_count
+            used = (local_used if local_day == day else 0) + 1
+            self._local_count = (day, used)
+
+        if used > limit:
+            # Handed back so a refused call under a lower limit doesn't use up room a higher limit still has
+            used -= 1
+            if shared:
+                await call_redis('decr', lambda client: client.decr(key))
+            else:
+                self._local_count = (day, used)
+            self._last_seen = (day, used)
+            return False
+        self._last_seen = (day, used)
+        return True
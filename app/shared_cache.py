@@ -0,0 +1,294 @@
+import asyncio
+import json
+import time
+import uuid
+import zlib
+from typing import Any, Awaitable, Callable, Hashable
+from utils import append_to_log, import_in_background, REDIS_HOST
+from cache import SingleFlight, TTLCache
+from metrics import register_cache, observe_dependency_call
+
+# Two cache tiers for upstream lookups: a small in-process LRU (L1) in front of Redis (L2), which every worker and
+# container shares. A value fetched by one worker is served to the rest from Redis, and a cross-worker lock makes
+# concurrent misses for the same key wait for one fetch instead of each calling the upstream, so upstream call volume
+# doesn't grow with the number of workers.
+# Redis is an optimization only. When it's down or slow each worker falls back to its L1 and fetches on its own,
+# and L2 is skipped for SHARED_CACHE_REDIS_RETRY_SECONDS rather than timing out on every request.
+SHARED_CACHE_REDIS_PORT = 6379
+SHARED_CACHE_KEY_PREFIX = 'finance-api:cache:'
+SHARED_CACHE_INVALIDATION_CHANNEL = 'finance-api:cache-invalidations'
+SHARED_CACHE_REDIS_TIMEOUT_SECONDS = 0.25
+SHARED_CACHE_REDIS_RETRY_SECONDS = 5
+SHARED_CACHE_REDIS_MAX_CONNECTIONS = 20
+# Values are stored as compact JSON, zlib compressed once they're big enough for it to pay off (e.g. transcripts)
+SHARED_CACHE_COMPRESS_MIN_BYTES = 1024
+SHARED_CACHE_JSON_PREFIX = b'j'
+SHARED_CACHE_ZLIB_PREFIX = b'z'
+# A worker that finds another worker's fetch lock polls L2 for the result, for at most the lock's lifetime
+SHARED_CACHE_LOCK_SECONDS = 15
+SHARED_CACHE_LOCK_POLL_MIN_SECONDS = 0.025
+SHARED_CACHE_LOCK_POLL_MAX_SECONDS = 0.25
+SHARED_CACHE_LISTENER_RECONNECT_MAX_SECONDS = 60
+
+# Identifies this process in invalidation messages so it skips its own
+WORKER_ID = uuid.uuid4().hex
+_redis_client = None
+_redis_unavailable_until = 0.0
+_listener_task = None
+_caches = {}
+
+
+def create_redis_client(socket_timeout: float = SHARED_CACHE_REDIS_TIMEOUT_SECONDS):
+    import redis.asyncio
+    from redis.asyncio.retry import Retry
+    from redis.backoff import NoBackoff
+    # No retries: redis-py's default backs off for seconds, and a cache lookup should fail fast to the upstream fetch
+    return redis.asyncio.Redis(host=REDIS_HOST, port=SHARED_CACHE_REDIS_PORT, socket_timeout=socket_timeout, socket_connect_timeout=SHARED_CACHE_REDIS_TIMEOUT_SECONDS, max_connections=SHARED_CACHE_REDIS_MAX_CONNECTIONS, retry=Retry(NoBackoff(), 0))
+
+
+def get_redis_client():
+    # None until the lifespan has created the client, or while Redis is marked unavailable
+    if _redis_client is None or time.monotonic() < _redis_unavailable_until:
+        return None
+    return _redis_client
+
+
+def mark_redis_unavailable(operation: str, error: Exception) -> None:
+    global _redis_unavailable_until
+    # Logged once per outage rather than once per request
+    if time.monotonic() >= _redis_unavailable_until:
+        append_to_log('ERROR', f'Shared cache Redis {operation} failed, using in-process caches only for {SHARED_CACHE_REDIS_RETRY_SECONDS} seconds: {repr(error)}')
+    _redis_unavailable_until = time.monotonic() + SHARED_CACHE_REDIS_RETRY_SECONDS
+
+
+async def call_redis(operation: str, call: Callable[[Any], Awaitable[Any]], default: Any = None) -> Any:
+    # Runs call(client) with timing, returning default instead of raising if Redis is unavailable or fails
+    client = get_redis_client()
+    if client is None:
+        return default
+    start = time.monotonic()
+    try:
+        result = await call(client)
+    except Exception as e:
+        observe_dependency_call('redis', operation, time.monotonic() - start, failed=True)
+        mark_redis_unavailable(operation, e)
+        return default
+    observe_dependency_call('redis', operation, time.monotonic() - start)
+    return result
+
+
+def encode_cache_key(key: Hashable) -> str:
+    # e.g. 'AAPL', or ('AAPL', 2024, 3) -> 'AAPL:2024:3'
+    return ':'.join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+
+
+def serialize_cache_value(value: Any, fetched_at: float) -> bytes:
+    payload = json.dumps([fetched_at, value], separators=(',', ':')).encode()
+    if len(payload) >= SHARED_CACHE_COMPRESS_MIN_BYTES:
+        return SHARED_CACHE_ZLIB_PREFIX + zlib.compress(payload)
+    return SHARED_CACHE_JSON_PREFIX + payload
+
+
+def deserialize_cache_value(data: bytes) -> tuple:
+    # Returns (value, fetched_at). JSON has no tuples, and every cached value is either a tuple or a string.
+    payload = zlib.decompress(data[1:]) if data[:1] == SHARED_CACHE_ZLIB_PREFIX else data[1:]
+    fetched_at, value = json.loads(payload)
+    return (tuple(value) if isinstance(value, list) else value), fetched_at
+
+
+class TwoTierCache:
+    """
+    A TTLCache per worker backed by Redis shared between workers. Same get_or_fetch contract as TTLCache:
+    concurrent misses share one fetch, fetch should raise on failure, and the last good value is served if it does.
+    Values must be JSON serializable. None and '' are returned but not cached, so the next request fetches again.
+    """
+
+    def __init__(self, namespace: str, ttl_seconds: float, local_max_entries: int):
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.local = TTLCache(local_max_entries, ttl_seconds)
+        self._flights = SingleFlight()
+        self._stats = {'hits': 0, 'misses': 0, 'stale_served': 0, 'l1_hits': 0, 'l2_hits': 0, 'lock_waits': 0, 'invalidations_received': 0}
+        _caches[namespace] = self
+        register_cache(namespace, self.stats)
+
+    def get_redis_key(self, key: str) -> str:
+        return f'{SHARED_CACHE_KEY_PREFIX}{self.namespace}:{key}'
+
+    async def get_shared(self, key: str) -> Any:
+        # Fresh value from L2, also stored in L1 with the age it already has so it expires there at the same time
+        data = await call_redis('get', lambda client: client.get(self.get_redis_key(key)))
+        if data is None:
+            return None
+        try:
+            value, fetched_at = deserialize_cache_value(data)
+        except Exception as e:
+            append_to_log('ERROR', f'Unreadable shared cache entry {self.get_redis_key(key)}: {repr(e)}')
+            return None
+        age = max(0.0, time.time() - fetched_at)
+        if age >= self.ttl_seconds:
+            return None
+        self.local.set(key, value, age_seconds=age)
+        return value
+
+    async def set_shared(self, key: str, value: Any) -> None:
+        data = serialize_cache_value(value, time.time())
+        await call_redis('set', lambda client: client.set(self.get_redis_key(key), data, px=int(self.ttl_seconds * 1000)))
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], stale_on_error: bool = True) -> Any:
+        """
+        Returns the fresh value for key from L1 or L2, or awaits fetch() to refresh both.
+
+        :param key: The cache key (e.g., a ticker, or a (ticker, year, quarter) tuple).
+        :param fetch: Zero-argument coroutine function producing the value. Should raise on failure.
+        :param stale_on_error: Whether to fall back to this worker's expired value when fetch raises.
+        :return: The cached or freshly fetched value.
+        """
+        key = encode_cache_key(key)
+        value = self.local.get(key)
+        if value is not None:
+            self._stats['hits'] += 1
+            self._stats['l1_hits'] += 1
+            return value
+
+        try:
+            # Concurrent misses within this worker share one L2 lookup and fetch
+            return await self._flights.run(key, lambda: self._get_shared_or_fetch(key, fetch))
+        except Exception:
+            stale_value = self.local.get_stale(key) if stale_on_error else None
+            if stale_value is None:
+                raise
+            self._stats['stale_served'] += 1
+            return stale_value
+
+    async def _get_shared_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = await self.get_shared(key)
+        if value is not None:
+            self._stats['hits'] += 1
+            self._stats['l2_hits'] += 1
+            return value
+
+        # Only one worker fetches a key at a time. The others wait for its result to show up in L2.
+        lock_key = self.get_redis_key(key) + ':lock'
+        locked = await call_redis('set', lambda client: client.set(lock_key, WORKER_ID, nx=True, px=SHARED_CACHE_LOCK_SECONDS * 1000), default=True)
+        if not locked:
+            self._stats['lock_waits'] += 1
+            value = await self._wait_for_shared(key, lock_key)
+            if value is not None:
+                self._stats['hits'] += 1
+                self._stats['l2_hits'] += 1
+                return value
+
+        self._stats['misses'] += 1
+        try:
+            value = await fetch()
+            if value is not None and value != '':
+                self.local.set(key, value)
+                await self.set_shared(key, value)
+            return value
+        finally:
+            if locked:
+                await call_redis('delete', lambda client: client.delete(lock_key))
+
+    async def _wait_for_shared(self, key: str, lock_key: str) -> Any:
+        # Polls until the value appears, or the lock is released or expires without one (the other fetch failed)
+        deadline = time.monotonic() + SHARED_CACHE_LOCK_SECONDS
+        delay = SHARED_CACHE_LOCK_POLL_MIN_SECONDS
+        while time.monotonic() < deadline:
+            await asyncio.sleep(delay)
+            value = await self.get_shared(key)
+            if value is not None:
+                return value
+            if not await call_redis('exists', lambda client: client.exists(lock_key), default=0):
+                return None
+            delay = min(SHARED_CACHE_LOCK_POLL_MAX_SECONDS, delay * 2)
+        return None
+
+    def invalidate_local(self, key: Hashable = None) -> None:
+        self.local.invalidate(encode_cache_key(key) if key is not None else None)
+
+    async def invalidate(self, key: Hashable = None) -> None:
+        """
+        Removes one key, or every key when none is given, from this worker's L1, from Redis, and from every other
+        worker's L1 through pub/sub.
+        """
+        self.invalidate_local(key)
+        if key is not None:
+            await call_redis('delete', lambda client: client.delete(self.get_redis_key(encode_cache_key(key))))
+        else:
+            await call_redis('delete', self._delete_namespace)
+        message = json.dumps({'origin': WORKER_ID, 'namespace': self.namespace, 'key': encode_cache_key(key) if key is not None else None})
+        await call_redis('publish', lambda client: client.publish(SHARED_CACHE_INVALIDATION_CHANNEL, message))
+
+    async def _delete_namespace(self, client) -> None:
+        keys = [key async for key in client.scan_iter(match=f'{SHARED_CACHE_KEY_PREFIX}{self.namespace}:*', count=500)]
+        if keys:
+            await client.unlink(*keys)
+
+    def stats(self) -> dict:
+        local_stats = self.local.stats()
+        return {**self._stats, 'entries': local_stats['entries'], 'max_entries': self.local.max_entries, 'ttl_seconds': self.ttl_seconds, 'in_flight': self._flights.in_flight_count()}
+
+
+def handle_invalidation_message(data: bytes) -> None:
+    try:
+        message = json.loads(data)
+        cache = _caches.get(message['namespace'])
+    except Exception as e:
+        append_to_log('ERROR', f'Bad shared cache invalidation message {data}: {repr(e)}')
+        return
+    if cache is None or message['origin'] == WORKER_ID:
+        return
+    cache.local.invalidate(message['key'])
+    cache._stats['invalidations_received'] += 1
+
+
+async def listen_for_invalidations() -> None:
+    # Runs for the life of the app, resubscribing with backoff whenever the connection drops.
+    # While it's down other workers' invalidations are missed, so L1 entries can outlive them by up to their TTL.
+    global _redis_client
+    await import_in_background('redis.asyncio')
+    _redis_client = create_redis_client()
+    # A subscriber waits on its socket indefinitely between messages, so it gets a client without the read timeout
+    subscriber = create_redis_client(socket_timeout=None)
+    reconnect_delay = 1
+    try:
+        while True:
+            try:
+                async with subscriber.pubsub() as pubsub:
+                    await pubsub.subscribe(SHARED_CACHE_INVALIDATION_CHANNEL)
+                    reconnect_delay = 1
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            handle_invalidation_message(message['data'])
+            except Exception as e:
+                append_to_log('ERROR', f'Shared cache invalidation listener disconnected, resubscribing in {reconnect_delay} seconds: {repr(e)}')
+            await asyncio.sleep(reconnect_delay)
+            reconnect_delay = min(SHARED_CACHE_LISTENER_RECONNECT_MAX_SECONDS, reconnect_delay * 2)
+    finally:
+        await subscriber.aclose()
+
+
+def start_shared_cache() -> None:
+    # Called from the app lifespan. The Redis client is created by the listener task, after redis is imported off the loop.
+    global _listener_task
+    if _listener_task is None or _listener_task.done():
+        _listener_task = asyncio.create_task(listen_for_invalidations())
+
+
+async def stop_shared_cache() -> None:
+    global _listener_task, _redis_client
+    if _listener_task is not None:
+        _listener_task.cancel()
+        try:
+            await _listener_task
+        except asyncio.CancelledError:
+            pass
+        _listener_task = None
+    if _redis_client is not None:
+        await _redis_client.aclose()
+        _redis_client = None
+
+
+def get_shared_cache(namespace: str) -> TwoTierCache:
+    return _caches.get(namespace)
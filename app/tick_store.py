@@ -0,0 +1,100 @@
+import threading
+import numpy as np
+
+# Each tick is one float64 row of (timestamp, bid, ask), so a product's buffer costs 24 bytes per tick
+TICK_ROW_BYTES = 3 * 8
+TICK_STATS_PERCENTILES = [5, 25, 50, 75, 95]
+# A perp tick is only compared with a spot tick at most this much older
+BASIS_MAX_ALIGNMENT_SECONDS = 5.0
+
+
+class TickRingBuffer:
+    """
+    Fixed capacity store of (timestamp, bid, ask) ticks for one product. Once full the oldest ticks are overwritten,
+    so memory stays at capacity * TICK_ROW_BYTES no matter how long the collector runs.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.ticks = np.zeros((capacity, 3), dtype=np.float64)
+        self.next_index = 0
+        self.count = 0
+        # Written from the websocket thread, read from the event loop
+        self.lock = threading.Lock()
+
+    def append(self, timestamp: float, bid: float, ask: float) -> None:
+        with self.lock:
+            self.ticks[self.next_index] = (timestamp, bid, ask)
+            self.next_index = (self.next_index + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def window(self, start_time: float) -> np.ndarray:
+        # Copy of the ticks at or after start_time, oldest first
+        with self.lock:
+            if self.count < self.capacity:
+                ordered = self.ticks[:self.count].copy()
+            else:
+                ordered = np.concatenate((self.ticks[self.next_index:], self.ticks[:self.next_index]))
+        return ordered[np.searchsorted(ordered[:, 0], start_time, side='left'):]
+
+    def stats(self) -> dict:
+        return {'ticks': self.count, 'capacity': self.capacity, 'bytes': self.ticks.nbytes}
+
+
+def create_tick_buffers(product_ids: list, max_bytes: int) -> dict:
+    # Splits the memory budget evenly between products
+    capacity = max(1, max_bytes // (len(product_ids) * TICK_ROW_BYTES))
+    return {product_id: TickRingBuffer(capacity) for product_id in product_ids}
+
+
+def get_percentiles(values: np.ndarray) -> dict:
+    if len(values) == 0:
+        return {f'p{percentile}': None for percentile in TICK_STATS_PERCENTILES}
+    return {f'p{percentile}': float(value) for percentile, value in zip(TICK_STATS_PERCENTILES, np.percentile(values, TICK_STATS_PERCENTILES))}
+
+
+def get_quote_stats(ticks: np.ndarray) -> dict:
+    # Mid and spread over a product's ticks, spread in basis points of mid
+    if len(ticks) == 0:
+        return {'ticks': 0, 'mid_last': None, 'mid_mean': None, 'spread_mean': None, 'spread_bps': get_percentiles(ticks)}
+    mid = (ticks[:, 1] + ticks[:, 2]) / 2
+    spread = ticks[:, 2] - ticks[:, 1]
+    return {'ticks': len(ticks), 'mid_last': float(mid[-1]), 'mid_mean': float(mid.mean()), 'spread_mean': float(spread.mean()), 'spread_bps': get_percentiles(spread / mid * 1e4)}
+
+
+def get_basis_stats(spot_ticks: np.ndarray, perp_ticks: np.ndarray) -> dict:
+    """
+    Perp-vs-spot basis over two tick windows. Each perp tick is paired with the latest spot tick at or before it
+    (no more than BASIS_MAX_ALIGNMENT_SECONDS older), so the two products don't need to tick together.
+
+    :param spot_ticks: (timestamp, bid, ask) rows for the spot product, oldest first.
+    :param perp_ticks: (timestamp, bid, ask) rows for the perp product, oldest first.
+    :return: Basis in price, in basis points and as a percentage of spot (premium_pct). The premium is the raw price gap,
+        not a funding rate. The exchange sets funding from the premium averaged over each funding period, typically a
+        fraction of it, so the premium can't be annualized as if it were paid every period.
+    """
+    empty = {'samples': 0, 'last': None, 'mean': None, 'bps_last': None, 'bps_mean': None, 'bps': get_percentiles(np.empty(0)), 'premium_pct_last': None, 'premium_pct_mean': None}
+    if len(spot_ticks) == 0 or len(perp_ticks) == 0:
+        return empty
+
+    spot_index = np.searchsorted(spot_ticks[:, 0], perp_ticks[:, 0], side='right') - 1
+    aligned = spot_index >= 0
+    aligned[aligned] &= perp_ticks[aligned, 0] - spot_ticks[spot_index[aligned], 0] <= BASIS_MAX_ALIGNMENT_SECONDS
+    if not aligned.any():
+        return empty
+
+    spot_mid = (spot_ticks[spot_index[aligned], 1] + spot_ticks[spot_index[aligned], 2]) / 2
+    perp_mid = (perp_ticks[aligned, 1] + perp_ticks[aligned, 2]) / 2
+    basis = perp_mid - spot_mid
+    basis_bps = basis / spot_mid * 1e4
+    premium_pct = basis / spot_mid * 100
+    return {
+        'samples': int(aligned.sum()),
+        'last': float(basis[-1]),
+        'mean': float(basis.mean()),
+        'bps_last': float(basis_bps[-1]),
+        'bps_mean': float(basis_bps.mean()),
+        'bps': get_percentiles(basis_bps),
+        'premium_pct_last': float(premium_pct[-1]),
+        'premium_pct_mean': float(premium_pct.mean()),
+    }
@@ -0,0 +1,229 @@
+from fastapi import APIRouter, Response, Query, status, Header
+from utils import append_to_log, authorized_via_finance_token
+from mongo import get_mongo_client, get_earnings_call_transcripts_collection, get_earnings_call_transcript_search_collection
+from transcripts import fetch_earnings_call_transcript_from_api_ninjas, get_transcript_upsert, get_transcript_search_upsert, TRANSCRIPT_UNAVAILABLE
+from rate_limit import TokenBucket
+from typing import Annotated
+import argparse
+import asyncio
+import re
+import time
+
+# API Ninjas is paid per call and rate limited, so a backfill only ever fetches what Mongo doesn't have yet
+BACKFILL_CONCURRENCY = 3
+BACKFILL_REQUESTS_PER_SECOND = 2
+BACKFILL_WRITE_BATCH_SIZE = 20
+BACKFILL_MAX_KEYS = 2000
+
+router = APIRouter()
+_running_backfills = {}
+
+
+def get_backfill_jobs_collection():
+    return get_mongo_client()["finance"]["earnings_call_transcript_backfill_jobs"]
+
+
+def get_backfill_keys(tickers: list, start_year: int, start_quarter: int, end_year: int, end_quarter: int) -> list:
+    """
+    Expands tickers and an inclusive year/quarter range into (ticker, year, quarter) keys.
+
+    :param tickers: Stock ticker symbols (e.g., ['GOOGL', 'MSFT']).
+    :param start_year: First year of the range (e.g., 2023).
+    :param start_quarter: First quarter in start_year (e.g., 1).
+    :param end_year: Last year of the range (e.g., 2024).
+    :param end_quarter: Last quarter in end_year (e.g., 4).
+    :return: Every (ticker, year, quarter) in the range, oldest first per ticker.
+    """
+    keys = []
+    for ticker in tickers:
+        year, quarter = start_year, start_quarter
+        while (year, quarter) <= (end_year, end_quarter):
+            keys.append((ticker, year, quarter))
+            year, quarter = (year + 1, 1) if quarter == 4 else (year, quarter + 1)
+    return keys
+
+
+def get_backfill_job_id(tickers: list, start_year: int, start_quarter: int, end_year: int, end_quarter: int) -> str:
+    # Deterministic so running the same backfill again resumes the earlier checkpoint
+    return f"{','.join(sorted(tickers))}:{start_year}Q{start_quarter}-{end_year}Q{end_quarter}"
+
+
+def format_backfill_key(key: tuple) -> str:
+    return f'{key[0]}:{key[1]}Q{key[2]}'
+
+
+async def get_stored_transcript_keys(tickers: list, start_year: int, end_year: int) -> set:
+    # One query for every key in the range that already has a transcript, or is known to be unavailable and not due for a retry
+    query = {"ticker": {"$in": tickers}, "year": {"$gte": start_year, "$lte": end_year},
+             "$or": [{"transcript_zlib": {"$exists": True}}, {"transcript": {"$nin": ["", None]}}, {"status": TRANSCRIPT_UNAVAILABLE, "retry_after": {"$gt": time.time()}}]}
+    projection = {"ticker": 1, "year": 1, "quarter": 1, "_id": 0}
+    stored_keys = set()
+    async for record in get_earnings_call_transcripts_collection().find(query, projection=projection):
+        stored_keys.add((record["ticker"], record["year"], record["quarter"]))
+    return stored_keys
+
+
+async def write_backfill_batch(job_id: str, results: list) -> None:
+    # Bulk upsert the transcripts we got along with unavailable markers for the ones API Ninjas had nothing for,
+    # then checkpoint every key attempted so a resumed run skips them.
+    from pymongo import UpdateOne
+    operations = [UpdateOne(*get_transcript_upsert(ticker, year, quarter, transcript), upsert=True) for (ticker, year, quarter), transcript in results]
+    if operations:
+        await get_earnings_call_transcripts_collection().bulk_write(operations, ordered=False)
+    search_operations = [UpdateOne(*get_transcript_search_upsert(ticker, year, quarter, transcript), upsert=True) for (ticker, year, quarter), transcript in results if transcript]
+    if search_operations:
+        await get_earnings_call_transcript_search_collection().bulk_write(search_operations, ordered=False)
+    fetched = sum(1 for _, transcript in results if transcript)
+    await get_backfill_jobs_collection().update_one(
+        {"_id": job_id},
+        {"$addToSet": {"attempted": {"$each": [format_backfill_key(key) for key, _ in results]}},
+         "$inc": {"fetched": fetched, "unavailable": len(results) - fetched},
+         "$set": {"updated_at": time.time()}}
+    )
+
+
+async def run_transcript_backfill(tickers: list, start_year: int, start_quarter: int, end_year: int, end_quarter: int) -> dict:
+    """
+    Fetches every missing earnings call transcript for tickers over the year/quarter range and stores it in MongoDB.
+    Progress is checkpointed in earnings_call_transcript_backfill_jobs, so re-running a backfill that was interrupted or
+    failed resumes it. Re-running one that completed starts over, retrying any quarter whose unavailable marker expired.
+
+    :return: The final job document.
+    """
+    tickers = sorted({ticker.strip().upper() for ticker in tickers if ticker.strip() != ''})
+    job_id = get_backfill_job_id(tickers, start_year, start_quarter, end_year, end_quarter)
+    jobs = get_backfill_jobs_collection()
+
+    job = await jobs.find_one({"_id": job_id}) or {}
+    # The checkpoint only means something for a run that didn't finish. After a completed run the stored transcripts and
+    # unavailable markers (with their retry_after) decide what still needs fetching.
+    resuming = job.get("status") in ("running", "failed")
+    attempted = set(job.get("attempted", [])) if resuming else set()
+    keys = get_backfill_keys(tickers, start_year, start_quarter, end_year, end_quarter)
+    stored_keys = await get_stored_transcript_keys(tickers, start_year, end_year)
+    already_stored = sum(1 for key in keys if key in stored_keys)
+    missing_keys = [key for key in keys if key not in stored_keys and format_backfill_key(key) not in attempted]
+
+    job_fields = {"tickers": tickers, "start": f'{start_year}Q{start_quarter}', "end": f'{end_year}Q{end_quarter}', "total": len(keys), "already_stored": already_stored, "remaining": len(missing_keys), "status": "running", "updated_at": time.time()}
+    if not resuming:
+        job_fields.update({"attempted": [], "fetched": 0, "unavailable": 0, "errors": 0})
+    await jobs.update_one({"_id": job_id}, {"$set": job_fields}, upsert=True)
+    append_to_log('INFO', f"Transcript backfill {job_id}: {len(keys)} keys, {already_stored} already stored, {len(missing_keys)} to fetch.")
+
+    semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+    bucket = TokenBucket(BACKFILL_REQUESTS_PER_SECOND, 1)
+    write_lock = asyncio.Lock()
+    pending_results = []
+
+    async def flush_results() -> None:
+        batch = pending_results[:]
+        pending_results.clear()
+        if batch:
+            await write_backfill_batch(job_id, batch)
+            await jobs.update_one({"_id": job_id}, {"$inc": {"remaining": -len(batch)}})
+
+    async def fetch_key(key: tuple) -> None:
+        async with semaphore:
+            await bucket.acquire()
+            try:
+                transcript = await fetch_earnings_call_transcript_from_api_ninjas(*key)
+            except Exception as e:
+                # Not checkpointed, so the next run tries this key again
+                append_to_log('ERROR', f"Transcript backfill {job_id} failed to fetch {format_backfill_key(key)}: {repr(e)}")
+                await jobs.update_one({"_id": job_id}, {"$inc": {"errors": 1, "remaining": -1}})
+                return
+        async with write_lock:
+            pending_results.append((key, transcript))
+            if len(pending_results) >= BACKFILL_WRITE_BATCH_SIZE:
+                await flush_results()
+
+    try:
+        await asyncio.gather(*[fetch_key(key) for key in missing_keys])
+        async with write_lock:
+            await flush_results()
+        # Done with the checkpoint, a later run of the same backfill starts over
+        await jobs.update_one({"_id": job_id}, {"$set": {"status": "completed", "attempted": [], "updated_at": time.time()}})
+    except Exception as e:
+        # Whatever made it into a checkpoint is kept, the next run picks up from there
+        append_to_log('ERROR', f"Transcript backfill {job_id} failed: {repr(e)}")
+        await jobs.update_one({"_id": job_id}, {"$set": {"status": "failed", "error": repr(e), "updated_at": time.time()}})
+        raise
+
+    return await jobs.find_one({"_id": job_id}, projection={"attempted": 0})
+
+
+def is_valid_backfill_request(tickers: list, start_year: int, start_quarter: int, end_year: int, end_quarter: int) -> bool:
+    if len(tickers) < 1 or not all(re.match("^[a-zA-Z0-9.]{1,12}$", ticker) for ticker in tickers):
+        return False
+    if not (1 <= start_quarter <= 4 and 1 <= end_quarter <= 4) or (start_year, start_quarter) > (end_year, end_quarter):
+        return False
+    quarter_count = (end_year * 4 + end_quarter) - (start_year * 4 + start_quarter) + 1
+    return len(tickers) * quarter_count <= BACKFILL_MAX_KEYS
+
+
+@router.post("/backfill-earnings-call-transcripts", status_code=202)
+async def backfill_earnings_call_transcripts(response: Response, tickers: str = Query(..., description="Comma separated stock ticker symbols"), start_year: int = Query(...), start_quarter: int = Query(...), end_year: int = Query(...), end_quarter: int = Query(...), token: Annotated[str | None, Header()] = None):
+    try:
+        if not authorized_via_finance_token(token):
+            response.status_code = status.HTTP_401_UNAUTHORIZED
+            return {}
+
+        ticker_list = sorted({ticker.strip().upper() for ticker in tickers.split(',') if ticker.strip() != ''})
+        if not is_valid_backfill_request(ticker_list, start_year, start_quarter, end_year, end_quarter):
+            append_to_log('ERROR', f'Bad transcript backfill submitted. Tickers: {tickers}, Range: {start_year}Q{start_quarter}-{end_year}Q{end_quarter}')
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {}
+
+        # Runs in the background, poll the status endpoint for progress
+        job_id = get_backfill_job_id(ticker_list, start_year, start_quarter, end_year, end_quarter)
+        if job_id not in _running_backfills:
+            task = asyncio.create_task(run_transcript_backfill(ticker_list, start_year, start_quarter, end_year, end_quarter))
+            _running_backfills[job_id] = task
+            task.add_done_callback(lambda _: _running_backfills.pop(job_id, None))
+        return {"job_id": job_id}
+
+    except Exception as e:
+        append_to_log('ERROR', f"Exception in backfill_earnings_call_transcripts: {repr(e)}")
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return {}
+
+
+@router.get("/earnings-call-transcript-backfill-status", status_code=200)
+async def earnings_call_transcript_backfill_status(response: Response, job_id: str = Query(..., description="Job id returned by the backfill endpoint"), token: Annotated[str | None, Header()] = None):
+    try:
+        if not authorized_via_finance_token(token):
+            response.status_code = status.HTTP_401_UNAUTHORIZED
+            return {}
+
+        job = await get_backfill_jobs_collection().find_one({"_id": job_id}, projection={"attempted": 0})
+        if job is None:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            return {}
+        return job
+
+    except Exception as e:
+        append_to_log('ERROR', f"Exception in earnings_call_transcript_backfill_status: {repr(e)}")
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return {}
+
+
+def parse_year_quarter(value: str) -> tuple:
+    # e.g. 2024Q3
+    match = re.match(r"^(\d{4})Q([1-4])$", value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f'Expected YYYYQn, got {value}')
+    return int(match.group(1)), int(match.group(2))
+
+
+if __name__ == '__main__':
+    # e.g. python transcript_backfill.py --tickers AAPL,MSFT --start 2022Q1 --end 2024Q4
+    parser = argparse.ArgumentParser(description='Backfill earnings call transcripts into MongoDB. Re-run the same command to resume.')
+    parser.add_argument('--tickers', required=True, help='Comma separated stock ticker symbols')
+    parser.add_argument('--start', required=True, type=parse_year_quarter, help='First quarter, e.g. 2022Q1')
+    parser.add_argument('--end', required=True, type=parse_year_quarter, help='Last quarter, e.g. 2024Q4')
+    args = parser.parse_args()
+
+    ticker_list = sorted({ticker.strip().upper() for ticker in args.tickers.split(',') if ticker.strip() != ''})
+    if not is_valid_backfill_request(ticker_list, *args.start, *args.end):
+        parser.error('Invalid tickers or quarter range.')
+    print(asyncio.run(run_transcript_backfill(ticker_list, *args.start, *args.end)))
@@ -0,0 +1,96 @@
+"""
+Correctness and parse-time benchmark for the GuruFocus quote extractor.
+
+Runs extract_quote_from_gurufocus_html over every page in gurufocus_corpus/, checks the result
+against expected.json and reports the median parse time per page. Real summary pages are several
+megabytes, so each page is padded with filler markup ahead of the quote to keep timings realistic.
+
+Every page is a synthetic regression fixture, not a saved GuruFocus page: hand-built pages at the top level, and in
+gurufocus_corpus/comment_snippets/ the snippets quoted in the original parser's comments, which only cover price
+extraction. See gurufocus_corpus/README.md.
+
+Usage (from the repo root):
+    python bench/bench_gurufocus_parsing.py [--iterations 50] [--pad-bytes 2000000]
+
+Exits non-zero if any page parses incorrectly.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(BENCH_DIR, 'gurufocus_corpus')
+# Each directory has its own expected.json
+CORPUS_SUBDIRS = ['', 'comment_snippets']
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+from prices import extract_quote_from_gurufocus_html, format_gurufocus_market_cap_in_billions
+
+FILLER = '<div class="fundamental-row" data-v-5a1c1d2e><span class="t-caption">Revenue per share</span><span>12.34</span></div>\n'
+
+
+def pad_page(source: str, pad_bytes: int) -> str:
+    # Put the filler right after <body> so the extractor has to walk it before reaching the quote.
+    # The comment snippets have no <body>, so it goes at the start.
+    if pad_bytes <= 0:
+        return source
+    filler = FILLER * (pad_bytes // len(FILLER) + 1)
+    body_index = source.index('<body>') + len('<body>') if '<body>' in source else 0
+    return source[:body_index] + filler + source[body_index:]
+
+
+def check_page(source: str, expected: dict) -> list:
+    quote = extract_quote_from_gurufocus_html(source, expected['ticker'])
+    market_cap_billions = None
+    if quote['market_cap'] != None:
+        market_cap_billions = format_gurufocus_market_cap_in_billions(quote['market_cap'], quote['market_cap_unit'])
+    actual = {**quote, 'market_cap_billions': market_cap_billions}
+
+    mismatches = []
+    for field in ('price', 'currency', 'market_cap', 'market_cap_unit', 'market_cap_billions'):
+        if actual[field] != expected[field]:
+            mismatches.append(f'{field}: expected {expected[field]!r}, got {actual[field]!r}')
+    return mismatches
+
+
+def time_page(source: str, ticker: str, iterations: int) -> float:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        extract_quote_from_gurufocus_html(source, ticker)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark GuruFocus quote extraction against the saved page corpus.')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--pad-bytes', type=int, default=2000000)
+    args = parser.parse_args()
+
+    expected_by_page = {}
+    for subdir in CORPUS_SUBDIRS:
+        with open(os.path.join(CORPUS_DIR, subdir, 'expected.json'), encoding='utf-8') as f:
+            expected_by_page.update({os.path.join(subdir, page_name): expected for page_name, expected in json.load(f).items()})
+
+    failures = 0
+    print(f'{"page":<48} {"result":<8} {"median ms":>10}')
+    for page_name, expected in sorted(expected_by_page.items()):
+        with open(os.path.join(CORPUS_DIR, page_name), encoding='utf-8') as f:
+            source = pad_page(f.read(), args.pad_bytes)
+
+        mismatches = check_page(source, expected)
+        median_seconds = time_page(source, expected['ticker'], args.iterations)
+        print(f'{page_name:<48} {"ok" if not mismatches else "FAIL":<8} {median_seconds * 1000:>10.3f}')
+        for mismatch in mismatches:
+            print(f'    {mismatch}')
+        failures += 1 if mismatches else 0
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+Import-time budget for the API.
+
+Imports main in fresh interpreters with -X importtime and checks that
+  - the median time to import main stays within --budget-ms, and
+  - none of the heavy dependencies the app defers to first use (or to the lifespan's background imports) get pulled
+    in at import time.
+The slowest top-level imports are listed so a regression points at its cause.
+
+Usage (from the repo root):
+    python bench/import_budget.py [--runs 5] [--budget-ms 600] [--top 10]
+
+Exits non-zero if the budget is exceeded or a deferred module is imported by main.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'app')
+
+# Imported inside the functions that use them. See the note in utils.import_in_background.
+DEFERRED_MODULES = ['sqlalchemy', 'psycopg2', 'pymongo', 'redis', 'numpy', 'coinbase', 'tick_store']
+
+
+def run_import(extra_code: str = '') -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import main{extra_code}'], cwd=APP_DIR, capture_output=True, text=True, check=True)
+
+
+def parse_importtime(stderr: str) -> list:
+    # Lines look like 'import time:       self [us] |  cumulative | imported package', nesting shown by indentation
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append({'name': name.strip(), 'depth': depth, 'self_ms': int(self_us) / 1000, 'cumulative_ms': int(cumulative_us) / 1000})
+    return entries
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Fail if importing the app gets slower than the budget or imports deferred modules.')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters to time, the median is compared with the budget')
+    parser.add_argument('--budget-ms', type=float, default=600, help='Maximum median time to import main')
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports under main to list')
+    args = parser.parse_args()
+
+    totals = []
+    entries = []
+    for _ in range(args.runs):
+        entries = parse_importtime(run_import().stderr)
+        totals.append(next(entry['cumulative_ms'] for entry in reversed(entries) if entry['name'] == 'main' and entry['depth'] == 0))
+    median_ms = statistics.median(totals)
+
+    loaded = json.loads(run_import('; import sys, json; print(json.dumps(sorted(sys.modules)))').stdout)
+    imported_deferred = sorted({module for module in DEFERRED_MODULES for name in loaded if name == module or name.startswith(module + '.')})
+
+    print(f'import main: median {median_ms:.1f} ms over {args.runs} runs (min {min(totals):.1f}, max {max(totals):.1f}), budget {args.budget_ms:.0f} ms\n')
+    print('slowest imports under main (last run):')
+    print(f'{"module":<40}{"cumulative ms":>15}{"self ms":>10}')
+    children = [entry for entry in entries if entry['depth'] == 1]
+    for entry in sorted(children, key=lambda entry: entry['cumulative_ms'], reverse=True)[:args.top]:
+        print(f'{entry["name"]:<40}{entry["cumulative_ms"]:>15.1f}{entry["self_ms"]:>10.1f}')
+
+    failed = False
+    if median_ms > args.budget_ms:
+        print(f'\nFAIL: importing main takes {median_ms:.1f} ms, over the {args.budget_ms:.0f} ms budget')
+        failed = True
+    if imported_deferred:
+        print(f'\nFAIL: importing main pulls in deferred modules: {", ".join(imported_deferred)}')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,680 @@
+"""
+Offline load test for the whole API.
+
+Runs the FastAPI app (in-process through httpx's ASGI transport, or under uvicorn with --uvicorn) with every
+external dependency replaced by a local stand-in, then drives each endpoint at a fixed concurrency and reports
+p50/p99 latency and requests/s. Nothing leaves the machine:
+
+    GuruFocus      synthetic pages from gurufocus_corpus/, streamed in chunks
+    Alpha Vantage  recorded responses from recorded_payloads/alpha_vantage.json (rate limits lifted)
+    API Ninjas     recorded transcript from recorded_payloads/api_ninjas_earningstranscript.json
+    logging        accepts and discards log records
+    Coinbase       a fake websocket client generating ticker messages on its own thread
+    Redis          a fixed secrets dict in place of the Redis fetch, and an in-memory store for the shared cache
+    Mongo          an in-memory collection store covering the queries the app makes
+    Postgres       SQLite files through the app's own engine registry and pool settings
+
+--upstream-latency-ms adds a simulated network delay to every faked HTTP call. The event loop monitor's stats are printed
+after the table; run with FINANCE_API_LOOP_DEBUG=1 to also have blocking calls made on the loop logged.
+
+Usage (from the repo root):
+    python bench/loadtest.py [--requests 500] [--concurrency 20] [--upstream-latency-ms 50] [--endpoints quote,fx] [--cold] [--uvicorn]
+
+After the load, each batch endpoint is also sent symbols containing the batch format's separators to check every
+record still comes back as SYMBOL,value,value in request order.
+
+Exits non-zero if any endpoint returned an unexpected status or a batch response was malformed.
+"""
+import argparse
+import asyncio
+import copy
+import fnmatch
+import json
+import os
+import random
+import re
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(BENCH_DIR, 'gurufocus_corpus')
+PAYLOADS_DIR = os.path.join(BENCH_DIR, 'recorded_payloads')
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+import httpx
+import sqlalchemy
+import utils
+import coinbase.websocket
+import http_clients
+import mongo
+import alpha_vantage
+import coinbase_tools
+import prices
+import shared_cache
+import transcripts
+import main
+from rate_limit import DailyQuota, TokenBucket
+
+FINANCE_TOKEN = 'bench-token'
+FAKE_SECRETS = {'secrets': {
+    'finance_tools': {'api_token': FINANCE_TOKEN},
+    'logging_microservice': {'api_token': 'bench-logging-token'},
+    'api_keys': {'alpha_vantage': 'bench-alpha-vantage-key'},
+    'api-ninjas': {'api_key': 'bench-api-ninjas-key'},
+    'coinbase_api_key': {'name': 'bench-coinbase-key', 'privateKey': 'bench-coinbase-secret'},
+}}
+GURUFOCUS_CHUNK_BYTES = 64 * 1024
+TRANSCRIPT_TICKERS = ['AAPL', 'MSFT', 'GOOGL', 'AMZN', 'NVDA']
+TRANSCRIPT_YEARS = [2023, 2024]
+FX_CURRENCIES = ['EUR', 'GBP', 'JPY', 'CAD', 'AUD', 'CHF']
+SEARCH_QUERIES = ['capex guidance', 'tariffs', 'free cash flow', 'gross margin']
+# name -> (path, query parameter, symbols). Records are separated by ; and fields by , so the bad symbols here mustn't
+# leak either into the response.
+BATCH_FORMAT_CHECKS = {
+    'quotes_batch': ('/get-stock-prices-and-market-caps-gurufocus', 'tickers', ['LVS', 'A$', 'B;C', 'BRK.A', 'HKSE:00700']),
+    'fx_batch': ('/get-forex-conversions', 'currencies', ['EUR', 'U$D', 'GB;P', 'JPY']),
+}
+
+
+# ---- Upstream HTTP ----
+
+class ChunkedByteStream(httpx.AsyncByteStream):
+    # Delivers a body in fixed-size chunks like a real network read, so the streaming GuruFocus fetch behaves as in production
+    def __init__(self, body: bytes):
+        self.body = body
+
+    async def __aiter__(self):
+        for offset in range(0, len(self.body), GURUFOCUS_CHUNK_BYTES):
+            yield self.body[offset:offset + GURUFOCUS_CHUNK_BYTES]
+            await asyncio.sleep(0)
+
+
+class RecordedTransport(httpx.AsyncBaseTransport):
+    """
+    Serves recorded payloads for one upstream after an optional simulated latency.
+    """
+
+    def __init__(self, upstream: str, payloads: dict, latency_seconds: float):
+        self.upstream = upstream
+        self.payloads = payloads
+        self.latency_seconds = latency_seconds
+        self.requests = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        if self.latency_seconds > 0:
+            await asyncio.sleep(self.latency_seconds * random.uniform(0.5, 1.5))
+        return getattr(self, f'handle_{self.upstream}')(request)
+
+    def handle_gurufocus(self, request: httpx.Request) -> httpx.Response:
+        # e.g. /stock/LVS/summary
+        match = re.match(r'^/stock/([^/]+)/summary$', request.url.path)
+        page = self.payloads['gurufocus_pages'].get(match.group(1).upper()) if match else None
+        if page is None:
+            return httpx.Response(404, content=b'Not found')
+        return httpx.Response(200, headers={'Content-Type': 'text/html; charset=utf-8'}, stream=ChunkedByteStream(page))
+
+    def handle_alpha_vantage(self, request: httpx.Request) -> httpx.Response:
+        params = request.url.params
+        function = params.get('function')
+        if function == 'CURRENCY_EXCHANGE_RATE':
+            currency = params.get('to_currency')
+            rate = self.payloads['alpha_vantage']['usd_rates'].get(currency)
+            if rate is None:
+                return httpx.Response(200, json={'Error Message': 'Invalid API call.'})
+            payload = copy.deepcopy(self.payloads['alpha_vantage']['CURRENCY_EXCHANGE_RATE'])
+            payload['Realtime Currency Exchange Rate']['3. To_Currency Code'] = currency
+            payload['Realtime Currency Exchange Rate']['5. Exchange Rate'] = rate
+            return httpx.Response(200, json=payload)
+        if function in ('OVERVIEW', 'TIME_SERIES_INTRADAY'):
+            return httpx.Response(200, json=self.payloads['alpha_vantage'][function])
+        return httpx.Response(200, json={'Error Message': 'Invalid API call.'})
+
+    def handle_api_ninjas(self, request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json=self.payloads['api_ninjas_transcript'])
+
+    def handle_logging(self, request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={})
+
+
+def load_payloads(gurufocus_page_bytes: int) -> dict:
+    with open(os.path.join(CORPUS_DIR, 'expected.json')) as f:
+        expected = json.load(f)
+    pages = {}
+    for file_name, fields in expected.items():
+        with open(os.path.join(CORPUS_DIR, file_name), encoding='utf-8') as f:
+            source = f.read()
+        # Real summary pages are megabytes, with the quote some way in
+        body_index = source.index('<body>') + len('<body>')
+        filler = '<div class="fundamental-row"><span>Revenue per share</span><span>12.34</span></div>\n'
+        source = source[:body_index] + filler * (gurufocus_page_bytes // len(filler)) + source[body_index:]
+        pages[fields['ticker'].upper()] = source.encode('utf-8')
+    with open(os.path.join(PAYLOADS_DIR, 'alpha_vantage.json')) as f:
+        alpha_vantage_payloads = json.load(f)
+    with open(os.path.join(PAYLOADS_DIR, 'api_ninjas_earningstranscript.json')) as f:
+        transcript_payload = json.load(f)
+    return {'gurufocus_pages': pages, 'alpha_vantage': alpha_vantage_payloads, 'api_ninjas_transcript': transcript_payload}
+
+
+# ---- Mongo ----
+
+def get_field(document: dict, key: str):
+    return document.get(key)
+
+
+def matches_condition(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+        for operator, operand in condition.items():
+            if operator == '$in' and not (any(item in operand for item in value) if isinstance(value, list) else value in operand):
+                return False
+            if operator == '$nin' and (value in operand):
+                return False
+            if operator == '$all' and not (isinstance(value, list) and all(item in value for item in operand)):
+                return False
+            if operator == '$exists' and (value is not None) != operand:
+                return False
+            if operator == '$gt' and not (value is not None and value > operand):
+                return False
+            if operator == '$gte' and not (value is not None and value >= operand):
+                return False
+            if operator == '$lt' and not (value is not None and value < operand):
+                return False
+            if operator == '$lte' and not (value is not None and value <= operand):
+                return False
+            if operator == '$ne' and value == operand:
+                return False
+        return True
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value == condition
+
+
+def matches_query(document: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(matches_query(document, clause) for clause in condition):
+                return False
+        elif key == '$and':
+            if not all(matches_query(document, clause) for clause in condition):
+                return False
+        elif not matches_condition(get_field(document, key), condition):
+            return False
+    return True
+
+
+def apply_projection(document: dict, projection: dict) -> dict:
+    if not projection:
+        return copy.deepcopy(document)
+    included = [key for key, value in projection.items() if value and key != '_id']
+    if included:
+        result = {key: copy.deepcopy(document[key]) for key in included if key in document}
+        if projection.get('_id', 1) and '_id' in document:
+            result['_id'] = document['_id']
+        return result
+    return {key: copy.deepcopy(value) for key, value in document.items() if projection.get(key, 1)}
+
+
+def apply_update(document: dict, update: dict, inserted: bool) -> None:
+    for key, value in update.get('$set', {}).items():
+        document[key] = copy.deepcopy(value)
+    if inserted:
+        for key, value in update.get('$setOnInsert', {}).items():
+            document[key] = copy.deepcopy(value)
+    for key in update.get('$unset', {}):
+        document.pop(key, None)
+    for key, value in update.get('$inc', {}).items():
+        document[key] = document.get(key, 0) + value
+    for key, value in update.get('$addToSet', {}).items():
+        items = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+        existing = document.setdefault(key, [])
+        existing.extend(item for item in items if item not in existing)
+
+
+class FakeUpdateResult:
+    def __init__(self, matched_count: int):
+        self.acknowledged = True
+        self.matched_count = matched_count
+
+
+class FakeCursor:
+    def __init__(self, documents: list):
+        self.documents = documents
+
+    def sort(self, key: str, direction: int = 1) -> 'FakeCursor':
+        self.documents.sort(key=lambda document: (document.get(key) is not None, document.get(key)), reverse=direction < 0)
+        return self
+
+    def limit(self, count: int) -> 'FakeCursor':
+        if count:
+            self.documents = self.documents[:count]
+        return self
+
+    async def to_list(self, length: int = None) -> list:
+        return self.documents[:length] if length else self.documents
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for document in self.documents:
+            yield document
+
+
+class FakeCollection:
+    """
+    An in-memory collection with the parts of the pymongo async API the app uses. Linear scans, so timings reflect
+    the app's own work rather than an index.
+    """
+
+    def __init__(self):
+        self.documents = []
+
+    async def create_index(self, *args, **kwargs) -> str:
+        return kwargs.get('name', 'index')
+
+    async def find_one(self, query: dict, projection: dict = None) -> dict:
+        for document in self.documents:
+            if matches_query(document, query):
+                return apply_projection(document, projection)
+        return None
+
+    def find(self, query: dict = None, projection: dict = None) -> FakeCursor:
+        return FakeCursor([apply_projection(document, projection) for document in self.documents if matches_query(document, query or {})])
+
+    def update(self, query: dict, update: dict, upsert: bool) -> int:
+        for document in self.documents:
+            if matches_query(document, query):
+                apply_update(document, update, inserted=False)
+                return 1
+        if upsert:
+            document = {key: value for key, value in query.items() if not key.startswith('$') and not isinstance(value, dict)}
+            apply_update(document, update, inserted=True)
+            self.documents.append(document)
+        return 0
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False) -> FakeUpdateResult:
+        return FakeUpdateResult(self.update(query, update, upsert))
+
+    async def bulk_write(self, operations: list, ordered: bool = True) -> None:
+        # pymongo's UpdateOne keeps its arguments in private attributes
+        for operation in operations:
+            self.update(operation._filter, operation._doc, operation._upsert)
+
+
+class FakeMongoClient:
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, database: str) -> dict:
+        return self.databases.setdefault(database, FakeDatabase())
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeDatabase(dict):
+    def __missing__(self, collection: str) -> FakeCollection:
+        self[collection] = FakeCollection()
+        return self[collection]
+
+
+# ---- Coinbase ----
+
+class FakeWSClient:
+    """
+    Stands in for coinbase.websocket.WSClient. After subscribe it calls on_message from its own thread with ticker
+    and heartbeat messages, like the SDK does.
+    """
+
+    ticks_per_second = 200
+
+    def __init__(self, api_key=None, api_secret=None, on_message=None, timeout=None, retry=True, **kwargs):
+        self.on_message = on_message
+        self.product_ids = []
+        self.loop = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def open(self) -> None:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def subscribe(self, product_ids: list, channels: list) -> None:
+        self.product_ids = product_ids
+        self.thread.start()
+
+    def run(self) -> None:
+        mids = {product_id: 60000.0 if product_id.startswith('BTC') else 3000.0 for product_id in self.product_ids}
+        interval = 1 / self.ticks_per_second
+        last_heartbeat = 0.0
+        while not self.stopped.wait(interval):
+            product_id = random.choice(self.product_ids)
+            mids[product_id] *= 1 + random.gauss(0, 0.0001)
+            spread = mids[product_id] * 0.00002
+            self.on_message(json.dumps({'channel': 'ticker', 'events': [{'type': 'update', 'tickers': [{'product_id': product_id, 'best_bid': f'{mids[product_id] - spread:.2f}', 'best_ask': f'{mids[product_id] + spread:.2f}'}]}]}))
+            if time.time() - last_heartbeat >= 1:
+                last_heartbeat = time.time()
+                self.on_message(json.dumps({'channel': 'heartbeats', 'events': [{'current_time': str(last_heartbeat)}]}))
+
+    def raise_background_exception(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+
+
+# ---- Redis (shared cache) ----
+
+class FakePubSub:
+    def __init__(self, redis: 'FakeAsyncRedis'):
+        self.redis = redis
+        self.messages = asyncio.Queue()
+
+    async def __aenter__(self) -> 'FakePubSub':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def subscribe(self, channel: str) -> None:
+        self.redis.subscribers.setdefault(channel, []).append(self)
+
+    async def listen(self):
+        while True:
+            yield await self.messages.get()
+
+    async def aclose(self) -> None:
+        for subscribers in self.redis.subscribers.values():
+            if self in subscribers:
+                subscribers.remove(self)
+
+
+class FakeAsyncRedis:
+    """
+    The redis.asyncio calls the shared cache and the daily quotas make, against a dict with expiry. One instance stands
+    in for both the cache client and the subscriber client, so published invalidations reach the listener.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.subscribers = {}
+
+    def live_value(self, key: str):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry[0] if entry is not None else None
+
+    async def get(self, key: str):
+        return self.live_value(key)
+
+    async def set(self, key: str, value, px: int = None, nx: bool = False):
+        if nx and self.live_value(key) is not None:
+            return None
+        self.data[key] = (value.encode() if isinstance(value, str) else value, time.monotonic() + px / 1000 if px else None)
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    async def unlink(self, *keys: str) -> int:
+        return await self.delete(*keys)
+
+    async def incr(self, key: str) -> int:
+        return await self.add_to_counter(key, 1)
+
+    async def decr(self, key: str) -> int:
+        return await self.add_to_counter(key, -1)
+
+    async def add_to_counter(self, key: str, amount: int) -> int:
+        value = int(self.live_value(key) or 0) + amount
+        expires_at = self.data[key][1] if key in self.data else None
+        self.data[key] = (str(value).encode(), expires_at)
+        return value
+
+    async def expireat(self, key: str, when: int) -> bool:
+        if self.live_value(key) is None:
+            return False
+        self.data[key] = (self.data[key][0], time.monotonic() + when - time.time())
+        return True
+
+    async def exists(self, key: str) -> int:
+        return 1 if self.live_value(key) is not None else 0
+
+    async def scan_iter(self, match: str = '*', count: int = None):
+        for key in [key for key in self.data if fnmatch.fnmatchcase(key, match)]:
+            yield key
+
+    async def publish(self, channel: str, message: str) -> int:
+        subscribers = self.subscribers.get(channel, [])
+        for subscriber in subscribers:
+            subscriber.messages.put_nowait({'type': 'message', 'channel': channel.encode(), 'data': message.encode()})
+        return len(subscribers)
+
+    def pubsub(self) -> FakePubSub:
+        return FakePubSub(self)
+
+    async def aclose(self) -> None:
+        pass
+
+
+fake_redis = FakeAsyncRedis()
+
+
+# ---- Postgres ----
+
+def create_sqlite_engine(workdir: str):
+    # Same pool settings and statement timing as utils.create_postgres_engine, on a SQLite file per database
+    def create_engine(database: str):
+        engine = sqlalchemy.create_engine(
+            f'sqlite:///{os.path.join(workdir, database)}.db',
+            connect_args={'check_same_thread': False},
+            pool_size=utils.POSTGRES_POOL_SIZE,
+            max_overflow=utils.POSTGRES_MAX_OVERFLOW,
+            pool_timeout=utils.POSTGRES_POOL_TIMEOUT_SECONDS,
+            pool_pre_ping=True,
+        )
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', utils.start_postgres_statement_timer)
+        sqlalchemy.event.listen(engine, 'after_cursor_execute', utils.observe_postgres_statement)
+        return engine
+    return create_engine
+
+
+def copy_rows_with_executemany(writer):
+    # SQLite has no COPY, so the bench writer inserts each batch with executemany on a pooled connection instead
+    def copy_rows(table: str, rows: list) -> None:
+        entry = writer.tables[table]
+        connection = utils.checkout_postgres_connection(writer.database, raw=True)
+        try:
+            cursor = connection.cursor()
+            cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} ({entry["column_definitions"]})')
+            cursor.executemany(f'INSERT INTO {table} ({", ".join(entry["columns"])}) VALUES ({", ".join("?" for _ in entry["columns"])})', rows)
+            connection.commit()
+        finally:
+            connection.close()
+    return copy_rows
+
+
+def install_fakes(args: argparse.Namespace, workdir: str) -> None:
+    payloads = load_payloads(args.gurufocus_page_bytes)
+    latency_seconds = args.upstream_latency_ms / 1000
+    http_clients.create_http_client = lambda upstream: httpx.AsyncClient(transport=RecordedTransport(upstream, payloads, latency_seconds))
+    utils.get_secrets_dict_from_redis = lambda: copy.deepcopy(FAKE_SECRETS)
+    shared_cache.create_redis_client = lambda socket_timeout=None: fake_redis
+    mongo._client = FakeMongoClient()
+    utils.create_postgres_engine = create_sqlite_engine(workdir)
+    # The collector imports WSClient from the SDK when it starts
+    coinbase.websocket.WSClient = FakeWSClient
+    coinbase_tools.crypto_futures_writer.copy_rows = copy_rows_with_executemany(coinbase_tools.crypto_futures_writer)
+    # The real per-minute and per-day quotas would make the FX endpoints wait on the scheduler instead of measuring the app
+    alpha_vantage._minute_bucket = TokenBucket(10 ** 9, 60)
+    alpha_vantage._day_quota = DailyQuota('alpha_vantage', 10 ** 9)
+
+
+async def seed_transcripts() -> None:
+    # Some quarters are stored up front (Mongo hits), the rest come from the fake API Ninjas on first request
+    with open(os.path.join(PAYLOADS_DIR, 'api_ninjas_earningstranscript.json')) as f:
+        base_transcript = json.load(f)['transcript']
+    for ticker in TRANSCRIPT_TICKERS:
+        for year in TRANSCRIPT_YEARS:
+            for quarter in (1, 2, 3):
+                transcript = f'{ticker} {year} Q{quarter} earnings call.\n\n' + '\n\n'.join([base_transcript] * 15)
+                await transcripts.upsert_earnings_call_transcript(ticker, year, quarter, transcript)
+
+
+# ---- Load ----
+
+def get_endpoints() -> dict:
+    # name -> (method, url for the i-th request)
+    # BRK.A is in the corpus but the single-quote endpoint rejects tickers with dots
+    quote_tickers = ['LVS', 'IDN', 'SPY', 'MIC:SBER', 'HKSE:00700']
+    return {
+        'heartbeat': ('GET', lambda i: '/'),
+        'quote': ('GET', lambda i: f'/get-stock-price-and-market-cap-gurufocus?ticker={quote_tickers[i % len(quote_tickers)]}'),
+        'quotes_batch': ('GET', lambda i: f'/get-stock-prices-and-market-caps-gurufocus?tickers={",".join(quote_tickers)}'),
+        'fx': ('GET', lambda i: f'/get-forex-conversion?currency={FX_CURRENCIES[i % len(FX_CURRENCIES)]}'),
+        'fx_cross': ('GET', lambda i: f'/get-forex-conversion?currency={FX_CURRENCIES[i % len(FX_CURRENCIES)]}&base=GBP'),
+        'fx_batch': ('GET', lambda i: f'/get-forex-conversions?currencies={",".join(FX_CURRENCIES)}'),
+        'transcript': ('GET', lambda i: f'/get-earnings-call-transcript?ticker={TRANSCRIPT_TICKERS[i % len(TRANSCRIPT_TICKERS)]}&year={TRANSCRIPT_YEARS[i % 2]}&quarter={i % 4 + 1}'),
+        'transcript_search': ('GET', lambda i: f'/search-earnings-call-transcripts?query={SEARCH_QUERIES[i % len(SEARCH_QUERIES)]}&start_year=2023&end_year=2024'),
+        'crypto_basis': ('GET', lambda i: '/crypto-basis-stats?coin=btc&window_seconds=60'),
+        'crypto_write': ('POST', lambda i: '/write-crypto-futures-data'),
+        'metrics': ('GET', lambda i: '/metrics'),
+    }
+
+
+def clear_caches() -> None:
+    # Both tiers, so the next request goes to the (fake) upstream
+    prices.quote_cache.invalidate_local()
+    prices.fx_rate_cache.invalidate_local()
+    fake_redis.data.clear()
+
+
+async def run_endpoint(client: httpx.AsyncClient, method: str, url_for, requests: int, concurrency: int, cold: bool) -> dict:
+    latencies = []
+    failures = {}
+    next_index = iter(range(requests))
+
+    async def worker() -> None:
+        for i in next_index:
+            if cold:
+                clear_caches()
+            start = time.perf_counter()
+            response = await client.request(method, url_for(i), headers={'token': FINANCE_TOKEN})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                failures[response.status_code] = failures.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': requests,
+        'requests_per_second': requests / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'failures': failures,
+    }
+
+
+async def check_batch_formats(client: httpx.AsyncClient) -> list:
+    # Returns a description of each malformed batch response
+    problems = []
+    for name, (path, parameter, symbols) in BATCH_FORMAT_CHECKS.items():
+        response = await client.get(path, params={parameter: ','.join(symbols)}, headers={'token': FINANCE_TOKEN})
+        if response.status_code != 200:
+            problems.append(f'{name}: status {response.status_code}')
+            continue
+        records = response.json().split(';')
+        if len(records) != len(symbols) or any(len(record.split(',')) != 3 for record in records):
+            problems.append(f'{name}: expected {len(symbols)} records of 3 fields for {symbols}, got {response.json()!r}')
+    return problems
+
+
+def print_report(results: dict, loop_stats: dict, format_problems: list, args: argparse.Namespace) -> None:
+    print(f'\n{args.requests} requests per endpoint, concurrency {args.concurrency}, upstream latency {args.upstream_latency_ms} ms, '
+          f'{"cold caches" if args.cold else "warm caches"}, {"uvicorn" if args.uvicorn else "in-process"}\n')
+    print(f'{"endpoint":<20}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}  failures')
+    for name, result in results.items():
+        failures = ', '.join(f'{status}x{count}' for status, count in result['failures'].items()) or '-'
+        print(f'{name:<20}{result["requests_per_second"]:>10.1f}{result["p50_ms"]:>10.2f}{result["p99_ms"]:>10.2f}{result["max_ms"]:>10.2f}  {failures}')
+    print(f'\nevent loop: max lag {loop_stats["max_lag_seconds"] * 1000:.1f} ms, blocked {loop_stats["blocked"]} times, '
+          f'{loop_stats["blocking_calls"]} blocking calls on the loop{"" if loop_stats["strict"] else " (strict mode off)"}')
+    if loop_stats['last_blocked_stack']:
+        print(f'last blocked in:\n{loop_stats["last_blocked_stack"]}')
+    print(f'\nbatch format checks: {len(BATCH_FORMAT_CHECKS) - len(format_problems)}/{len(BATCH_FORMAT_CHECKS)} passed')
+    for problem in format_problems:
+        print(f'  {problem}')
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def run_load(args: argparse.Namespace, base_url: str, transport: httpx.AsyncBaseTransport = None) -> tuple:
+    endpoints = get_endpoints()
+    selected = args.endpoints.split(',') if args.endpoints else list(endpoints)
+    results = {}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, limits=limits, timeout=60) as client:
+        # Give the fake websocket a moment to fill the tick buffers
+        await asyncio.sleep(args.warmup_seconds)
+        for name in selected:
+            method, url_for = endpoints[name]
+            results[name] = await run_endpoint(client, method, url_for, args.requests, args.concurrency, args.cold)
+        format_problems = await check_batch_formats(client)
+        loop_stats = (await client.get('/event-loop-stats', headers={'token': FINANCE_TOKEN})).json()
+    return results, loop_stats, format_problems
+
+
+async def run(args: argparse.Namespace) -> tuple:
+    if args.uvicorn:
+        import uvicorn
+        port = get_free_port()
+        server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=port, log_level='warning'))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.05)
+        try:
+            await seed_transcripts()
+            return await run_load(args, f'http://127.0.0.1:{port}/finance-api')
+        finally:
+            server.should_exit = True
+            await server_task
+
+    async with main.app.router.lifespan_context(main.app):
+        await seed_transcripts()
+        return await run_load(args, 'http://bench/finance-api', httpx.ASGITransport(app=main.app))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline load test for every endpoint with local fakes for all dependencies.')
+    parser.add_argument('--requests', type=int, default=500, help='Requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=20, help='Concurrent requests in flight per endpoint')
+    parser.add_argument('--upstream-latency-ms', type=float, default=50, help='Mean simulated latency added to every faked HTTP upstream call')
+    parser.add_argument('--gurufocus-page-bytes', type=int, default=1000000, help='Filler ahead of the quote in each GuruFocus page')
+    parser.add_argument('--endpoints', default='', help=f'Comma separated subset of: {",".join(get_endpoints())}')
+    parser.add_argument('--cold', action='store_true', help='Clear the quote and FX caches before every request')
+    parser.add_argument('--uvicorn', action='store_true', help='Serve the app with uvicorn on a local port instead of in-process')
+    parser.add_argument('--warmup-seconds', type=float, default=1.0, help='Wait before the first endpoint so the fake websocket has produced ticks')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.endpoints.split(',') if name and name not in get_endpoints()]
+    if unknown:
+        parser.error(f'Unknown endpoints: {", ".join(unknown)}')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        install_fakes(args, workdir)
+        results, loop_stats, format_problems = asyncio.run(run(args))
+    print_report(results, loop_stats, format_problems, args)
+    sys.exit(1 if format_problems or any(result['failures'] for result in results.values()) else 0)